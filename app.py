@@ -1,17 +1,29 @@
 import streamlit as st
-import boto3
+from botocore.exceptions import ClientError, ReadTimeoutError, EndpointConnectionError
+import hashlib
+import html
 import json
-from botocore.exceptions import ClientError
-from botocore.credentials import Credentials
-import pandas as pd
-import csv
-import re
-import os
-import uuid
-import base64
-import tempfile
-from datetime import datetime
-from io import StringIO
+from io import BytesIO
+from result_cache import AnalysisCache, DEFAULT_CACHE_DIR, DEFAULT_HISTORY_DIR, content_hash
+from catalog import DEFAULT_REFRESH_SECONDS, get_catalog, normalize_title
+from template_parser import make_template_fetcher
+from wa_updates import describe_plan
+from aws_clients import S3_TRANSFER_CONCURRENCY, get_client_factory
+from metrics import log_event, registry, stage, start_metrics_server, timed, use_trace
+from jobs import DONE, QUEUED, JobRunner
+from wa_review import (
+    DEFAULT_LENS_ALIAS,
+    PENDING_REASON,
+    MilestoneCache,
+    RiskSummary,
+    analyze_template,
+    create_workload_milestone,
+    explain_practices,
+    get_review_report,
+    get_review_snapshot,
+    summarize_snapshot_risks,
+    update_answers
+)
 
 # Access secrets using st.secrets
 aws_access_key_id = st.secrets["aws_access_key_id"]
@@ -20,51 +32,123 @@ region_name = st.secrets["region"]
 
 # Specify the workload parameters
 workload_id = st.secrets["workload_id"]
-lens_alias = 'wellarchitected'
+lens_alias = DEFAULT_LENS_ALIAS
 
 # AWS S3 Configuration
 s3_bucket = st.secrets["s3_bucket"] 
 
-# Initialize AWS clients
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name=region_name
-)
+# AWS clients are created on first use, once per server process, and shared by all sessions
+client_factory = get_client_factory(st.secrets.to_dict())
 
-bedrock_client = boto3.client(
-    'bedrock-runtime',
-    region_name=region_name,
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key
-)
+def s3_client():
+    return client_factory.client('s3')
 
-wa_client = boto3.client(
-    'wellarchitected',
-    region_name=region_name,
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key
-) 
-# Inject custom CSS for the expander
-st.markdown(
-    """
-    <style>
-    span[class="st-emotion-cache-1dtefog eqpbllx2"] p {
-        font-size: 20px !important; /* change 20px to increase or decrease the size */
-    }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+def bedrock_client():
+    return client_factory.client('bedrock-runtime')
+
+def wa_client():
+    return client_factory.client('wellarchitected')
+
+def inject_css():
+    # Inject custom CSS for the expander
+    st.markdown(
+        """
+        <style>
+        span[class="st-emotion-cache-1dtefog eqpbllx2"] p {
+            font-size: 20px !important; /* change 20px to increase or decrease the size */
+        }
+        </style>
+        """,
+        unsafe_allow_html=True
+    )
+
+@st.cache_resource
+def get_analysis_cache():
+    # One cache per server process, shared by all sessions
+    return AnalysisCache(
+        cache_dir=st.secrets.get("analysis_cache_dir", DEFAULT_CACHE_DIR),
+        max_bytes=int(st.secrets.get("analysis_cache_max_mb", 50)) * 1024 * 1024,
+        max_age_seconds=int(st.secrets.get("analysis_cache_max_age_hours", 168)) * 60 * 60
+    )
+
+@st.cache_resource
+def get_analysis_history():
+    # Last analyzed version of each uploaded template, so a new version only re-checks what changed
+    return AnalysisCache(
+        cache_dir=st.secrets.get("analysis_history_dir", DEFAULT_HISTORY_DIR),
+        max_age_seconds=int(st.secrets.get("analysis_history_max_age_hours", 720)) * 60 * 60
+    )
+
+@st.cache_resource
+def get_s3_transfer_config():
+    # Multipart settings for large templates: fewer, bigger parts sent in parallel.
+    # boto3 is imported on the first upload, not while the page starts.
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        max_concurrency=S3_TRANSFER_CONCURRENCY,
+        use_threads=True
+    )
+
+@timed('catalog_load')
+def load_catalog(best_practices_file_path):
+    # Parsed once per process and shared by all sessions; S3 is re-checked by ETag
+    return get_catalog(
+        s3_client(),
+        s3_bucket,
+        best_practices_file_path,
+        int(st.secrets.get("catalog_refresh_seconds", DEFAULT_REFRESH_SECONDS))
+    )
+
+def get_answers_snapshot(workload_id, lens_alias):
+    # All pillars' answers fetched in one concurrent round and shared until they change
+    return get_review_snapshot(wa_client(), workload_id, lens_alias, st.secrets)
 
 ##Functions related to Analyze button
+def s3_object_matches(s3_bucket, key, file_bytes, file_hash):
+    # HEAD the existing object and compare it with the local content
+    try:
+        head_response = s3_client().head_object(Bucket=s3_bucket, Key=key)
+    except ClientError as e:
+        # Missing, or unknown (e.g. 403 without s3:GetObject): either way the file is uploaded
+        code = e.response['Error']['Code']
+        if code not in ('404', 'NoSuchKey', 'NotFound'):
+            print(f"Could not check s3://{s3_bucket}/{key} ({code}), uploading it: {e}")
+        return False
+
+    if head_response.get('Metadata', {}).get('sha256') == file_hash:
+        return True
+
+    # Objects uploaded in a single PUT carry the MD5 of their body as ETag
+    etag = head_response.get('ETag', '').strip('"')
+    return '-' not in etag and etag == hashlib.md5(file_bytes, usedforsecurity=False).hexdigest()
+
 def upload_file_to_s3(uploaded_file, s3_bucket):
+    file_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    file_url = f"https://{s3_bucket}.s3.{s3_client().meta.region_name}.amazonaws.com/{uploaded_file.name}"
+
+    # Streamlit reruns the script on every interaction; only upload content this session has not sent yet
+    if 'uploaded_files' not in st.session_state:
+        st.session_state.uploaded_files = {}
+    if st.session_state.uploaded_files.get(uploaded_file.name) == file_hash:
+        st.success("Your workloads received successfully!")
+        return file_url
+
     try:
-        s3_client.upload_fileobj(uploaded_file, s3_bucket, uploaded_file.name)
-        file_url = f"https://{s3_bucket}.s3.{s3_client.meta.region_name}.amazonaws.com/{uploaded_file.name}"
+        with stage('upload', size=len(file_bytes)):
+            if not s3_object_matches(s3_bucket, uploaded_file.name, file_bytes, file_hash):
+                s3_client().upload_fileobj(
+                    BytesIO(file_bytes),
+                    s3_bucket,
+                    uploaded_file.name,
+                    ExtraArgs={'Metadata': {'sha256': file_hash}},
+                    Config=get_s3_transfer_config()
+                )
+        st.session_state.uploaded_files[uploaded_file.name] = file_hash
         #st.success(f"File uploaded successfully! URL: {file_url}")
-        st.success(f"Your workloads received successfully!")
+        st.success("Your workloads received successfully!")
         return file_url
     except ClientError as e:
         st.write(f"Access Key ID: {aws_access_key_id[:5]}...")  # Print only first 5 characters for security
@@ -74,377 +158,222 @@ def upload_file_to_s3(uploaded_file, s3_bucket):
         st.error(f"Error uploading file to S3: {e}")
         return None
 
-def analyze_template_with_bedrock(s3_url, best_practices_json_path):
-    model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-    # Load the best practices JSON from the file
-    try:
-        # Get the object from S3
-        response = s3_client.get_object(Bucket=s3_bucket, Key=best_practices_json_path)
-
-        # Read the content of the file
-        content = response['Body'].read().decode('utf-8')
-
-        # Parse the JSON content
-        best_practices = json.loads(content)
-
-    except ClientError as e:
-        print(f"Error reading file from S3: {e}")
-        return None
-
-    # Convert the best practices to a formatted JSON string
-    best_practices_json = json.dumps(best_practices, indent=2)
-
-    user_message = f"""
-    Analyze the following CloudFormation template from s3 URL:
-    {s3_url}
-    
-    For each of the following best practices from the AWS Well-Architected Framework, determine if it is applied in the given CloudFormation template s3 URL. 
-
-    Best Practices:
-    {best_practices_json}
-    
-    For each best practice, respond in the following EXACT format only: 
-    [Exact Best Practice Name as given in Best Practices]: [Why do you consider this best practice applicable?]
-
-    IMPORTANT: Use the EXACT best practice name as given in the Best Practices. 
-
-    Do not rephrase or summarize the practice name. List only the practices which are Applied
-    """
-    #for debugging
-    #print(user_message)
-
-    request_body = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 4096,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": user_message
-                    }
-                ]
-            }
-        ]
-    }
+def analysis_job(job, catalog, template_body, s3_url, settings, analysis_cache, template_name):
+    job.set_stage('Checking your workloads for AWS best practices...')
+    # Streamed practices are kept on the job so the page can show them while it runs
+    def add_practice(practice, reason, pillar, question):
+        job.add_event((practice, reason, pillar, question))
+    on_practice = add_practice if settings.get("analysis_streaming", True) else None
+
+    return analyze_template(
+        bedrock_client(),
+        catalog,
+        template_body,
+        settings,
+        analysis_cache=analysis_cache,
+        on_practice=on_practice,
+        source=s3_url,
+        # Nested stacks are read from S3, by default only from the upload bucket
+        fetch_template=make_template_fetcher(s3_client(), allowed_buckets=settings.get("nested_stack_buckets", [s3_bucket])),
+        analysis_history=get_analysis_history(),
+        history_key=f"{workload_id}/{template_name}"
+    )
 
-    try:
-        response = bedrock_client.invoke_model(
-            modelId=model_id,
-            contentType='application/json',
-            accept='application/json',
-            body=json.dumps(request_body)
+def progressive_result_renderer(container):
+    # Show each applied practice under its pillar and question as soon as it is parsed
+    container.title("BPs found in your architecture")
+    pillar_expanders = {}
+    question_containers = {}
+    shown_practices = set()
+
+    def render(practice, reason, pillar, question):
+        if practice in shown_practices:
+            return
+        shown_practices.add(practice)
+        if pillar not in pillar_expanders:
+            pillar_expanders[pillar] = container.expander(f"**{pillar}**", expanded=True)
+        if (pillar, question) not in question_containers:
+            question_container = pillar_expanders[pillar].container()
+            question_container.markdown(f"**{question}**")
+            question_containers[(pillar, question)] = question_container
+        question_containers[(pillar, question)].markdown(f"✔️ {practice}")
+        #question_containers[(pillar, question)].markdown(f"   Reason: {reason}")
+
+    return render
+
+def practice_explainer(template_body, catalog):
+    # explain(practice_ids) -> {practice id: reason}, one Bedrock call for the practices of a question
+    def explain(practice_ids):
+        return explain_practices(
+            bedrock_client(),
+            catalog,
+            template_body,
+            practice_ids,
+            st.secrets,
+            fetch_template=make_template_fetcher(s3_client(), allowed_buckets=st.secrets.get("nested_stack_buckets", [s3_bucket]))
         )
-        
-        response_body = json.loads(response['body'].read())
-        analysis_content = response_body.get('content', [])
-        
-        analysis_result = "\n".join(
-            item['text'] for item in analysis_content if item['type'] == 'text'
+    return explain
+
+def explain_questions(questions, reasons, explain):
+    # Reasons are only fetched when the user asks for them, and kept for the rest of the session
+    known_reasons = st.session_state.setdefault('practice_reasons', {})
+    missing = [
+        practice_id
+        for question in questions for practice_id, name, found in question['practices']
+        if found and practice_id not in known_reasons and reasons.get(practice_id, PENDING_REASON) == PENDING_REASON
+    ]
+    if missing:
+        try:
+            with st.spinner("Asking for the reasons..."):
+                known_reasons.update(explain(missing))
+        except (ClientError, ReadTimeoutError, EndpointConnectionError) as e:
+            st.error(f"Could not get the reasons: {e}")
+    return {**reasons, **known_reasons}
+
+def build_result_model(analysis_results, catalog, snapshot):
+    # pillar -> question -> applied practices, as plain data that is kept in session_state
+    reasons = {practice.id: reason for practice, reason in catalog.match_analysis(analysis_results)}
+    pillars = []
+    for pillar in catalog.pillars:
+        # Get the pillar ID
+        pillar_id = snapshot.pillar_id_for_name(pillar)
+        if not pillar_id:
+            print(f"Couldn't find PillarId for {pillar}. Skipping...")
+            continue
+
+        # Answers for each question under the current pillar
+        questions = []
+        for answer in snapshot.answers_by_pillar[pillar_id]:
+            practices = catalog.by_question_title.get(normalize_title(answer['QuestionTitle']))
+            if not practices:
+                continue
+            selected_choices = set(answer.get('SelectedChoices', []))
+
+            # (practice id, name, found by this analysis); previously applied practices come from the WA Tool
+            applied_practices = []
+            for entry in practices:
+                if snapshot.choice_id_for(answer['QuestionId'], entry.title) in selected_choices:
+                    applied_practices.append((entry.id, entry.name, False))
+                elif entry.id in reasons:
+                    applied_practices.append((entry.id, entry.name, True))
+            if applied_practices:
+                questions.append({'id': answer['QuestionId'], 'title': practices[0].question, 'practices': applied_practices})
+        pillars.append({'pillar': pillar, 'id': pillar_id, 'questions': questions})
+    return {'pillars': pillars, 'reasons': reasons}
+
+def result_model(analysis_results, catalog):
+    # Built once per analysis and catalog version; reruns repaint from session_state without any AWS call
+    key = (content_hash(analysis_results), catalog.etag)
+    cached = st.session_state.get('result_model')
+    if cached is None or cached[0] != key:
+        snapshot = get_answers_snapshot(workload_id, lens_alias)
+        cached = (key, build_result_model(analysis_results, catalog, snapshot))
+        st.session_state.result_model = cached
+    return cached
+
+def pillar_html(questions, reasons, explained):
+    # One markdown block per pillar; each question folds open in the browser without a rerun
+    blocks = []
+    for question in questions:
+        items = []
+        for practice_id, name, found in question['practices']:
+            item = f"✔️ {html.escape(name)}"
+            if found and question['id'] in explained:
+                item += f"<br><small>{html.escape(reasons.get(practice_id, PENDING_REASON))}</small>"
+            items.append(f"<li>{item}</li>")
+        blocks.append(
+            f"<details open><summary><b>{html.escape(question['title'])}</b></summary>"
+            f"<ul style=\"list-style: none;\">{''.join(items)}</ul></details>"
         )
-        #for debugging
-        #print(analysis_result)
-        return analysis_result
-
-    except ClientError as e:
-        error_code = e.response['Error']['Code']
-        error_message = e.response['Error']['Message']
-        st.error(f"AWS Error: {error_code} - {error_message}")
-        st.error("Please check your AWS credentials and permissions.")
-        return None
+    return ''.join(blocks)
 
-def display_result(analysis_results, file_path):
-    pattern = re.compile(r'\[(.*?)\]:\s*(.*)')
-    matches = pattern.findall(analysis_results)
-    
-    response = s3_client.get_object(Bucket=s3_bucket, Key=file_path)
-    content = response['Body'].read().decode('utf-8')
-    best_practices = pd.read_csv(StringIO(content))
-    
-    if best_practices.empty:
+@timed('display')
+def display_result(analysis_results, catalog, explain=None):
+    if not catalog.practices:
         st.error("No best practices could be loaded. Please check the file and try again.")
         return
-    
-    pillars = {}
-    for index, row in best_practices.iterrows():
-        pillar = row.get('Pillar', 'Unknown')
-        question = row.get('Question', 'Unknown')
-        practice = row.get('Best Practice', '')
-        
-        if pillar not in pillars:
-            pillars[pillar] = {}
-        if question not in pillars[pillar]:
-            pillars[pillar][question] = []
-        pillars[pillar][question].append(practice)
-    
-    st.title("BPs found in your architecture")
-    for pillar, questions in pillars.items():
-        with st.expander(f"**{pillar}**", expanded=False):
 
-        # Get the pillar ID
-            pillar_id = None
-            lens_review_response = wa_client.get_lens_review(
-                WorkloadId=workload_id,
-                LensAlias=lens_alias
-            )
-            for pillar_summary in lens_review_response.get('LensReview', {}).get('PillarReviewSummaries', []):
-                if pillar_summary.get('PillarName') == pillar:
-                    pillar_id = pillar_summary.get('PillarId')
-                    break
-        
-            if not pillar_id:
-                print(f"Couldn't find PillarId for {pillar}. Skipping...")
-                continue
-            
-            # Initialize pagination variables
-            next_token = None
-            
-            while True:
-                # Build the API request parameters
-                params = {
-                    'WorkloadId': workload_id,
-                    'LensAlias': lens_alias,
-                    'PillarId': pillar_id
-                }
-                if next_token:
-                    params['NextToken'] = next_token
-                
-                # Get answers for each question under the current pillar
-                answers_response = wa_client.list_answers(**params)
-                
-                for answer in answers_response['AnswerSummaries']:
-                    question_title = answer['QuestionTitle']
-                    selected_choices = answer['SelectedChoices']
-                    
-                    for question, practices in questions.items():
-                        before_dash, separator, after_dash = question.partition(' - ')
-                        if after_dash == question_title:
-                            st.session_state.update_button_enabled = True
-                            applied_practices = []
-                            
-                            choice_title_to_id = {choice['Title']: choice['ChoiceId'] for choice in answer.get('Choices', [])}
-                        
-                            for practice in practices:
-                                practice_text = ' '.join(practice.split(' ')[1:]).strip()
-                                if any(practice_text in choice['Title'] for choice in answer.get('Choices', []) if choice['ChoiceId'] in selected_choices):
-                                    applied_practices.append((practice, "Previously Applied"))
-                            
-                                for key, reason in matches:
-                                    if key.strip() == practice.strip():
-                                        if not any(practice == item[0] for item in applied_practices):
-                                            applied_practices.append((practice, reason))
-                            # Display the question and its applied practices if any are applied
-                            if applied_practices:
-                                st.markdown(f"**{question}**")
-                                st.session_state.update_button_enabled = True
-                                for practice, reason in applied_practices:
-                                    if reason == "Previously Applied":
-                                        st.markdown(f"✔️ {practice}")
-                                        #st.markdown(f"   Reason: {reason}")
-                                    else:
-                                        st.markdown(f"✔️ {practice}")
-                                        #st.markdown(f"   Reason: {reason}")
-            
-                # Check if there are more results
-                next_token = answers_response.get('NextToken')
-                if not next_token:
-                    break
-
-    # Enable the update button at the end of the function
-    st.session_state.update_button_enabled = True
+    key, model = result_model(analysis_results, catalog)
+    reasons = model['reasons']
 
-##Functions related to Update Button
-def update_workload(analysis_results, file_path):
-    # Fetch workload and lens review details
-    workload_response = wa_client.get_workload(WorkloadId=workload_id)
-    lens_review_response = wa_client.get_lens_review(WorkloadId=workload_id, LensAlias=lens_alias)
-
-    # Read best practices from S3
-    response = s3_client.get_object(Bucket=s3_bucket, Key=file_path)
-    content = response['Body'].read().decode('utf-8')
-    best_practices = pd.read_csv(StringIO(content))
-
-    # Parse analysis results
-    analysis_bp_list = [key for key, value in re.findall(r'\[(.*?)\]:\s*(.*?)', analysis_results)]
-
-    # Create mappings from Best Practice to Pillar and Question
-    practice_to_pillar_question = {}
-    for index, row in best_practices.iterrows():
-        pillar = row.get('Pillar', '').strip().lower()
-        question = row.get('Question', '').strip().lower()
-        practice = row.get('Best Practice', '').strip()
-        
-        # Remove all spaces from the pillar
-        pillar_no_spaces = pillar.replace(' ', '')
-        # Initialize the dictionary entry if it does not exist
-        if pillar_no_spaces not in practice_to_pillar_question:
-            practice_to_pillar_question[pillar_no_spaces] = []
-
-        for bp in analysis_bp_list:
-            if bp == practice:
-                practice_text = ' '.join(practice.split(' ')[1:]).strip().lower()
-                before_dash, separator, after_dash = question.partition(' - ')
-                practice_to_pillar_question[pillar_no_spaces].append({
-                        'Question': after_dash,
-                        'Practice': practice_text
-                })
-
-    # Iterate over Pillar IDs from the Lens Review response
-    for pillar_summary in lens_review_response.get('LensReview', {}).get('PillarReviewSummaries', []):
-        pillar_id = pillar_summary.get('PillarId', 'No PillarId')
-        print(f"Processing Pillar ID: {pillar_id}")
-
-        # Initialize pagination variables
-        next_token = None
-
-        while True:
-            try:
-                # Build the API request parameters
-                params = {
-                    'WorkloadId': workload_id,
-                    'LensAlias': lens_alias,
-                    'PillarId': pillar_id
-                }
-                if next_token:
-                    params['NextToken'] = next_token
-                
-                # Get questions for this pillar
-                questions_response = wa_client.list_answers(**params)
-                
-                # Print the response for debugging
-                #print(f"Questions response: {json.dumps(questions_response, indent=4)}")
-
-                # Process questions
-                for question in questions_response.get('AnswerSummaries', []):
-                    question_id = question.get('QuestionId', 'No QuestionId')
-                    question_title = question.get('QuestionTitle', 'No QuestionTitle')
-                    current_choices = question.get('SelectedChoices', [])
-                    updated_choices = current_choices
-                    print(f"Processing Question: {question_title}")
-
-                    # Iterate over the details list for the current pillar
-                    for key in practice_to_pillar_question.keys():
-                        if key.startswith(pillar_id.lower()):
-                            print(f"Key matched: {key}")
-                            for entry in practice_to_pillar_question[key]:
-                                practice1 = entry.get('Practice', 'No Practice')
-                                question1 = entry.get('Question', 'No Question')
-                                new_choice_ids = []
-                                if question1 == question_title.lower():
-                                    #print(f"Question matched: {question1}")
-                                    choice_title_to_id = {choice['Title']: choice['ChoiceId'] for choice in question.get('Choices', [])}
-                                    for new_choice_title, choice_id in choice_title_to_id.items():
-                                        if new_choice_title.lower() == practice1:
-                                            print(f"Practice matched: {practice1}")
-                                            new_choice_ids.append(choice_id)
-                                    #print(f"new_choice_ids = {new_choice_ids}")
-
-                                    updated_choices = list(set(updated_choices + new_choice_ids))  # Remove duplicates
-                                    # Update the answer with the merged choices
-                                    wa_client.update_answer(
-                                       WorkloadId=workload_id,
-                                       LensAlias=lens_alias,
-                                       QuestionId=question_id,
-                                       SelectedChoices=updated_choices,
-                                       Notes='Updated during review process'
-                                    )
-                                    print(f"Updated Question Title: {question_title} with Choices: {updated_choices}")
-
-                # Check if there is a next token
-                next_token = questions_response.get('NextToken')
-                if not next_token:
-                    break  # Exit the loop if no more pages are available
-
-            except ClientError as e:
-                print(f"Error retrieving or updating answers for Pillar ID {pillar_id}: {e}")
-                return e
-
-    create_milestone()
-    st.session_state.report_button_enabled = True
-    return "Success"
+    st.title("BPs found in your architecture")
+    for pillar in model['pillars']:
+        with st.expander(f"**{pillar['pillar']}**", expanded=False):
+            explained = []
+            found_questions = [question for question in pillar['questions'] if any(found for _, _, found in question['practices'])]
+            if found_questions and explain is not None:
+                # One widget per pillar instead of a button per question
+                titles = {question['id']: question['title'] for question in found_questions}
+                explained = st.multiselect(
+                    "Why? Explain the practices found for",
+                    list(titles),
+                    format_func=titles.get,
+                    key=f"why_{key[0][:12]}_{pillar['id']}"
+                )
+                if explained:
+                    reasons = explain_questions([question for question in found_questions if question['id'] in explained], reasons, explain)
+            if pillar['questions']:
+                st.markdown(pillar_html(pillar['questions'], reasons, explained), unsafe_allow_html=True)
 
-def create_milestone():
-    # Define a milestone name with current date and time
-    current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    milestone_name = f'Review completed on {current_datetime}'
-    client_request_token = str(uuid.uuid4())  # Generate a unique client request token
-  
+##Functions related to Update Button
+@st.cache_resource
+def get_risk_summary_cache():
+    # The risk summary of the latest milestone per workload, shared by all sessions
+    return MilestoneCache()
+
+def update_review(analysis_results, catalog, settings, set_stage=print):
+    # Updates the answers, creates a milestone and keeps its risk summary for summarize_risks;
+    # returns the milestone number. Run by the update job and by benchmark.py.
+    # A report prefetched for an earlier milestone is stale once the answers change again
+    get_job_runner().cancel_speculative(lambda dedup_key: dedup_key[:2] == ('report', workload_id))
+    set_stage('Updating Well-Architeced Review...')
+    # Seeded from the snapshot the update is planned from, then kept current from the update_answer responses
+    risk_summary = RiskSummary(get_review_snapshot(wa_client(), workload_id, lens_alias, settings))
+    plan, responses, errors = update_answers(wa_client(), workload_id, lens_alias, analysis_results, catalog, settings)
+    if errors:
+        raise next(iter(errors.values()))
+
+    set_stage('Creating a milestone...')
+    milestone_response = create_milestone()
+    milestone_number = milestone_response.get('MilestoneNumber') if milestone_response else None
+    if milestone_number is not None and settings.get("report_prefetch", True):
+        prefetch_report(milestone_number)
+
+    set_stage('Summarizing risks...')
+    with stage('risk_summary'):
+        risk_summary.apply_responses(responses)
+        get_risk_summary_cache().put(workload_id, lens_alias, milestone_number, risk_summary.summary())
+    return milestone_number
+
+def update_job(job, analysis_results, catalog, settings):
+    # The report button asks for the report of this milestone
+    return {'milestone_number': update_review(analysis_results, catalog, settings, job.set_stage)}
+
+def plan_workload_update(analysis_results, catalog):
+    # Dry run: the answer updates the update would make, without writing them
     try:
-        milestone_response = wa_client.create_milestone(
-            WorkloadId=workload_id,
-            MilestoneName=milestone_name,
-            ClientRequestToken=client_request_token
-        )
-        print("Milestone created")
-
-    except Exception as e:
-        print(f"Error creating milestone: {e}")
-
-def summarize_risks(workload_id, lens_alias):
-    # Initialize counters for different risk levels
-    pillar_summaries = {}
-    total_questions = 0
-    answered_questions = 0
+        plan, responses, errors = update_answers(wa_client(), workload_id, lens_alias, analysis_results, catalog, st.secrets, dry_run=True)
+    except ClientError as e:
+        print(f"Error retrieving answers for workload {workload_id}: {e}")
+        return e
+    return plan
 
-    # Retrieve all pillars for the lens review
-    lens_review_response = wa_client.get_lens_review(
-        WorkloadId=workload_id,
-        LensAlias=lens_alias
-    )
+def create_milestone():
+    return create_workload_milestone(wa_client(), workload_id)
 
-    # Loop through each pillar and list answers for each pillar
-    for pillar_summary in lens_review_response.get('LensReview', {}).get('PillarReviewSummaries', []):
-        pillar_id = pillar_summary.get('PillarId', 'No PillarId')
-        pillar_name = pillar_summary.get('PillarName', 'Unknown Pillar')
-
-        pillar_summaries[pillar_id] = {
-            'name': pillar_name,
-            'total': 0,
-            'answered': 0,
-            'high': 0,
-            'medium': 0,
-        }
+def summarize_risks(workload_id, lens_alias, milestone_number=None):
+    # The summary kept from the update that created the milestone, if there is one
+    cached = get_risk_summary_cache().get(workload_id, lens_alias, milestone_number)
+    if cached is not None:
+        return cached
 
-        # Initialize pagination variables
-        next_token = None
-
-        while True:
-            try:
-                # Build the API request parameters
-                params = {
-                    'WorkloadId': workload_id,
-                    'LensAlias': lens_alias,
-                    'PillarId': pillar_id
-                }
-                if next_token:
-                    params['NextToken'] = next_token
-                
-                # Get answers for each question under the current pillar
-                answers_response = wa_client.list_answers(**params)
-
-                for answer_summary in answers_response.get('AnswerSummaries', []):
-                    pillar_summaries[pillar_id]['total'] += 1
-                    total_questions += 1
-                    risk = answer_summary.get('Risk', 'UNANSWERED')
-                    if risk != 'UNANSWERED':
-                        pillar_summaries[pillar_id]['answered'] += 1
-                        answered_questions += 1
-                    if risk == 'HIGH':
-                        pillar_summaries[pillar_id]['high'] += 1
-                    elif risk == 'MEDIUM':
-                        pillar_summaries[pillar_id]['medium'] += 1
-
-                # Check if there is a next token
-                next_token = answers_response.get('NextToken')
-                if not next_token:
-                    break  # Exit the loop if no more pages are available
-
-            except ClientError as e:
-                print(f"Error retrieving answers for Pillar ID {pillar_id}: {e}")
-                break  # Exit the loop on error to prevent infinite retries
-
-    return pillar_summaries, total_questions, answered_questions
+    # Retrieve all pillars and their answers for the lens review
+    try:
+        snapshot = get_answers_snapshot(workload_id, lens_alias)
+    except ClientError as e:
+        print(f"Error retrieving answers for workload {workload_id}: {e}")
+        return {}, 0, 0
+    return summarize_snapshot_risks(snapshot)
 
 
 def display_risk_summary(pillar_summaries, total_questions, answered_questions):
@@ -479,45 +408,113 @@ def display_risk_summary(pillar_summaries, total_questions, answered_questions):
             "Medium Risks": pillar_data['medium'],
         })
     
-    # Create a DataFrame and display it as a table
-    df = pd.DataFrame(table_data)
-    df = df.reset_index(drop=True)
-    
-    html = df.to_html(index=False)
-
-    st.markdown(html, unsafe_allow_html=True)
+    st.markdown(html_table(table_data), unsafe_allow_html=True)
+
+def html_table(rows):
+    # Same markup as DataFrame.to_html(index=False), without loading pandas for a six-row table
+    columns = list(rows[0]) if rows else []
+    header = ''.join(f"<th>{html.escape(str(column))}</th>" for column in columns)
+    body = ''.join(
+        '<tr>' + ''.join(f"<td>{html.escape(str(row[column]))}</td>" for column in columns) + '</tr>'
+        for row in rows
+    )
+    return (f'<table border="1" class="dataframe"><thead><tr style="text-align: right;">{header}</tr></thead>'
+            f'<tbody>{body}</tbody></table>')
 
 #Functions related to Generate Button
-def generate_and_download_report(workload_id, lens_alias):
-    try:
-        # Generate the report using GetLensReviewReport API
-        response = wa_client.get_lens_review_report(
-            WorkloadId=workload_id,
-            LensAlias=lens_alias
-        )
-        
-        # Extract the Base64 encoded report data
-        base64_string = response.get('LensReviewReport', {}).get('Base64String')
-        
-        if not base64_string:
-            st.error("Failed to retrieve the report data.")
-            return None
-        
-        # Decode the Base64 string
-        report_data = base64.b64decode(base64_string)
-        
-        # Create a download link
-        b64 = base64.b64encode(report_data).decode()
-        href = f'<a href="data:application/pdf;base64,{b64}" download="WA_Review_Report_{workload_id}.pdf">Click here to download the report</a>'
-        st.markdown(href, unsafe_allow_html=True)
-        
-        return "Report generated successfully"
-    
-    except Exception as e:
-        st.error(f"Error generating report: {str(e)}")
+@st.cache_resource
+def get_report_cache():
+    # One report per workload and milestone, shared by all sessions
+    return MilestoneCache()
+
+def report_job(job, milestone_number):
+    job.set_stage('Generating Well-Architected Report...')
+    return get_review_report(wa_client(), workload_id, lens_alias, milestone_number, get_report_cache())
+
+def report_dedup_key(milestone_number):
+    # Without a milestone the report is of the current answers, which may change any time,
+    # so such a report is never shared with other clicks or sessions
+    if milestone_number is None:
         return None
-    
-    except ClientError as e:
+    return ('report', workload_id, milestone_number)
+
+def prefetch_report(milestone_number):
+    # Starts generating the report of a new milestone right away; the report button
+    # gets this job back through the same dedup key instead of making its own call
+    get_job_runner().submit('report', report_job, milestone_number, dedup_key=report_dedup_key(milestone_number), speculative=True)
+
+def show_report_download(report_pdf):
+    # The bytes are served from Streamlit's media endpoint instead of being inlined in the page;
+    # "ignore" keeps the click from rerunning the script
+    st.download_button(
+        "Download the report",
+        data=report_pdf,
+        file_name=f"WA_Review_Report_{workload_id}.pdf",
+        mime="application/pdf",
+        on_click="ignore"
+    )
+
+##Functions related to background jobs
+@st.cache_resource
+def get_job_runner():
+    # One bounded pool per server process; long steps of every session queue on it
+    metrics_file = st.secrets.get("metrics_file")
+
+    def on_finish(job):
+        log_event('job', kind=job.kind, status=job.status, seconds=round(job.elapsed, 3), **job.trace.summary())
+        if metrics_file:
+            registry.write_prometheus(metrics_file)
+
+    return JobRunner(
+        max_workers=int(st.secrets.get("job_max_workers", 4)),
+        retention_seconds=int(st.secrets.get("job_retention_minutes", 60)) * 60,
+        on_finish=on_finish
+    )
+
+@st.cache_resource
+def start_metrics_endpoint():
+    # Prometheus text endpoint next to the app, e.g. metrics_port = 9108
+    if st.secrets.get("metrics_port"):
+        start_metrics_server(int(st.secrets["metrics_port"]))
+
+def review_settings():
+    # Jobs run outside the script thread, so they get a plain copy of the secrets
+    return st.secrets.to_dict()
+
+def analysis_dedup_key(template_name, template_body, catalog, settings):
+    # The name picks the incremental history and the settings (models, modes, budgets) change
+    # the result, so only the same template under the same name and settings shares a job
+    settings_hash = content_hash(json.dumps(settings, sort_keys=True, default=str))
+    return ('analysis', template_name, content_hash(template_body), catalog.etag, settings_hash)
+
+def session_job(job_key):
+    job_id = st.session_state.get(job_key)
+    return get_job_runner().get(job_id) if job_id else None
+
+def wait_for_job(job, on_running=None):
+    # True once the job has finished. Until then a fragment polls its status
+    # every few seconds instead of keeping the script thread busy.
+    if not job.active:
+        return True
+
+    @st.fragment(run_every=float(st.secrets.get("job_poll_seconds", 1)))
+    def job_status():
+        if not job.active:
+            # Full rerun so buttons and results reflect the finished job
+            st.rerun()
+        if job.status == QUEUED:
+            st.info(f"Waiting for a free worker ({get_job_runner().queue_position(job)} reviews ahead)...")
+        else:
+            st.info(f"{job.stage} ({job.elapsed:.0f}s)")
+        if on_running is not None:
+            on_running(job)
+
+    job_status()
+    return False
+
+def show_job_error(job, message):
+    e = job.error
+    if isinstance(e, ClientError):
         error_code = e.response['Error']['Code']
         error_message = e.response['Error']['Message']
         st.error(f"AWS Error: {error_code} - {error_message}")
@@ -529,40 +526,63 @@ def generate_and_download_report(workload_id, lens_alias):
             st.error("You don't have permission to perform this operation. Check your IAM policies.")
         else:
             st.error("Please check your AWS credentials and permissions.")
-        return None
-    except Exception as e:
-        st.error(f"Unexpected error: {str(e)}")
-        return None
+    elif isinstance(e, (ReadTimeoutError, EndpointConnectionError)):
+        st.error(f"AWS did not respond: {e}")
+    else:
+        st.error(f"{message}: {e}")
+
+def show_streamed_practices(job):
+    render = progressive_result_renderer(st.container())
+    for practice, reason, pillar, question in job.events():
+        render(practice, reason, pillar, question)
+
+def show_timing_panel(job):
+    # Optional: where the time of the last step went, with its AWS calls and Bedrock tokens
+    if not st.secrets.get("show_timings", False):
+        return
+    trace = job.trace.summary()
+    with st.expander("Timings", expanded=False):
+        st.table([
+            {'Stage': name, 'Runs': stage_summary['count'], 'Seconds': stage_summary['seconds']}
+            for name, stage_summary in trace['stages'].items()
+        ])
+        counters = trace['counters']
+        st.caption(
+            f"AWS calls: {counters.get('aws_calls', 0)} ({counters.get('aws_retries', 0)} retries, "
+            f"{counters.get('aws_throttles', 0)} throttled) | Bedrock tokens: "
+            f"{counters.get('bedrock_input_tokens', 0)} in, {counters.get('bedrock_output_tokens', 0)} out"
+        )
 
 #Functions related to display
-def analyze_callback():
-    st.session_state.update_disabled = False
-    st.session_state.report_disabled = True
-    
-def update_callback():
-    st.session_state.report_disabled = False
+def sync_buttons_with_jobs():
+    # A button is only enabled once the job it builds on is done: the update needs this
+    # session's finished analysis, the report a finished update and its milestone
+    analysis = session_job('analysis_job_id')
+    if analysis is not None and analysis.status == DONE:
+        st.session_state.analysis_result = analysis.result
+    st.session_state.update_disabled = not st.session_state.analysis_result
+
+    update = session_job('update_job_id')
+    if update is not None and update.status == DONE:
+        st.session_state.milestone_number = update.result['milestone_number']
+        st.session_state.report_disabled = False
 
 # Main App
 def main():
+    inject_css()
     st.title("Are you Well-Architected? ✅")
+    start_metrics_endpoint()
 
     
     best_practices_file_path = 'well_architected_best_practices.json'
-    best_practices_csv_path = 'well_architected_best_practices.csv'
 
     # Initialize session state variables
     if 'analysis_result' not in st.session_state:
         st.session_state.analysis_result = None
     if 'analyze_disabled' not in st.session_state:
         st.session_state.analyze_disabled = False
-    if 'analyze_click' not in st.session_state:
-        st.session_state.analyze_click = 1
-    if 'update_click' not in st.session_state:
-        st.session_state.update_click = 1
-    if 'report_click' not in st.session_state:
-        st.session_state.report_click = 1
-    if 'report_link' not in st.session_state:
-        st.session_state.report_link = None
+    if 'active_view' not in st.session_state:
+        st.session_state.active_view = None
     if 'update_disabled' not in st.session_state:
         st.session_state.update_disabled = True
     if 'report_disabled' not in st.session_state:
@@ -575,77 +595,119 @@ def main():
     if uploaded_file is not None:
         s3_url = upload_file_to_s3(uploaded_file, s3_bucket)
 
+        sync_buttons_with_jobs()
         col1, col2, col3 = st.columns(3)
 
         with col1:
             analyze_button = st.button("AWS best practices I'm Using!", key='analyze_button', 
-                                       on_click=analyze_callback, 
                                        disabled=st.session_state.analyze_disabled)
         with col2:
             update_button = st.button("Complete a WA Review", key='update_button', 
-                                      on_click=update_callback,
                                       disabled=st.session_state.update_disabled)
         with col3:
             report_button = st.button("Show me Detailed Report", key='report_button',
                                       disabled=st.session_state.report_disabled)
         
+        jobs = get_job_runner()
+
+        # Buttons only submit background jobs; a repeated click or a refresh gets the same job back
         if s3_url and analyze_button:
-            if st.session_state.analyze_click == 1:
-                with st.spinner('Checking your workloads for AWS best practices...'):
-                    analysis_results = analyze_template_with_bedrock(s3_url, best_practices_file_path)
-                    st.session_state.analyze_click += 1
-                    st.session_state.analysis_result = analysis_results
-                    if st.session_state.analysis_result:
-                        display_result(st.session_state.analysis_result, best_practices_csv_path)
-                    else:
-                        st.error("Failed to analyze the template. Please try again.")
-                        st.session_state.update_disabled = True
-                        st.session_state.report_disabled = True
-            else:
-                display_result(st.session_state.analysis_result, best_practices_csv_path)
- 
-        if update_button and st.session_state.analysis_result:
-            if st.session_state.update_click == 1:
-                with st.spinner('Updating Well-Architeced Review...'):
-                    status = update_workload(st.session_state.analysis_result, best_practices_csv_path)
-                    if status == "Success":
-                        st.markdown("Well-Architected Review updated and a Milestone created")
-                        st.session_state.update_click += 1
-        
-                        pillar_summaries, total_questions, answered_questions = summarize_risks(workload_id, lens_alias)
-                        display_risk_summary(pillar_summaries, total_questions, answered_questions)
-                    else:
-                        st.write(f"Error in updating workload: {status}")
-                        st.session_state.update_disabled = False
-                        st.session_state.report_disabled = True
-            else:
-                pillar_summaries, total_questions, answered_questions = summarize_risks(workload_id, lens_alias)
-                display_risk_summary(pillar_summaries, total_questions, answered_questions)
-        
-        # Display report download link
-        if report_button and st.session_state.analysis_result:
-            if st.session_state.report_click == 1:
-                with st.spinner("Generating Well-Architected Report..."):
-                    try:
-                        response = wa_client.get_lens_review_report(
-                            WorkloadId=workload_id,
-                            LensAlias=lens_alias
-                        )
-                        base64_string = response.get('LensReviewReport', {}).get('Base64String')
-                        if base64_string:
-                            b64 = base64.b64encode(base64.b64decode(base64_string)).decode()
-                            href = f'<a href="data:application/pdf;base64,{b64}" download="WA_Review_Report_{workload_id}.pdf">Click here to download the report</a>'
-                            st.session_state.report_link = href
-                            st.markdown(href, unsafe_allow_html=True)
-                            st.session_state.report_click += 1
-                            st.success("Report generated successfully. Click the download button above to save the PDF.")
-                        else:
-                            st.error("Failed to retrieve the report data.")
-                    except Exception as e:
-                        st.error(f"Error generating report: {str(e)}")
+            catalog = load_catalog(best_practices_file_path)
+            template_body = uploaded_file.getvalue()
+            settings = review_settings()
+            job = jobs.submit(
+                'analysis', analysis_job, catalog, template_body, s3_url, settings, get_analysis_cache(), uploaded_file.name,
+                dedup_key=analysis_dedup_key(uploaded_file.name, template_body, catalog, settings)
+            )
+            st.session_state.analysis_job_id = job.id
+            st.session_state.active_view = 'analysis'
+            # Results, reasons and the update of the previous analysis must not be used for this one
+            st.session_state.analysis_result = None
+            st.session_state.practice_reasons = {}
+            st.session_state.pop('result_model', None)
+            st.session_state.pop('update_job_id', None)
+            st.session_state.pop('milestone_number', None)
+            st.session_state.report_disabled = True
+            # Rerun so the buttons reflect the new job
+            st.rerun()
+
+        dry_run = st.checkbox("Dry run: only show the answer changes a WA Review update would make", key='dry_run')
+
+        if update_button and st.session_state.analysis_result and dry_run:
+            st.session_state.active_view = None
+            plan = plan_workload_update(st.session_state.analysis_result, load_catalog(best_practices_file_path))
+            if isinstance(plan, ClientError):
+                st.write(f"Error in planning workload update: {plan}")
             else:
-                st.markdown(st.session_state.report_link, unsafe_allow_html=True)
-                st.success("Report generated successfully. Click the download button above to save the PDF.")
+                st.markdown(f"{len(plan)} questions would be updated ({len(plan)} update_answer calls)")
+                if plan:
+                    st.table(describe_plan(plan))
+        elif update_button and st.session_state.analysis_result:
+            job = jobs.submit(
+                'update', update_job, st.session_state.analysis_result, load_catalog(best_practices_file_path), review_settings(),
+                dedup_key=('update', workload_id, content_hash(st.session_state.analysis_result))
+            )
+            st.session_state.update_job_id = job.id
+            st.session_state.active_view = 'update'
+            # The update changes which practices count as previously applied
+            st.session_state.pop('result_model', None)
+            # The report waits for this update's milestone
+            st.session_state.pop('milestone_number', None)
+            st.session_state.report_disabled = True
+            st.rerun()
+
+        if report_button and not st.session_state.report_disabled:
+            milestone_number = st.session_state.get('milestone_number')
+            job = jobs.submit(
+                'report', report_job, milestone_number,
+                dedup_key=report_dedup_key(milestone_number)
+            )
+            st.session_state.report_job_id = job.id
+            st.session_state.active_view = 'report'
+
+        # Show the job behind the last clicked button: its progress while it runs, its result once done
+        if st.session_state.active_view == 'analysis' and session_job('analysis_job_id'):
+            job = session_job('analysis_job_id')
+            if wait_for_job(job, show_streamed_practices):
+                if job.status == DONE and job.result and st.session_state.update_disabled:
+                    # Finished after the buttons were drawn
+                    st.rerun()
+                if job.status == DONE and job.result:
+                    cache_stats = get_analysis_cache().stats()
+                    st.caption(f"Analysis cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+                    with use_trace(job.trace):
+                        catalog = load_catalog(best_practices_file_path)
+                        display_result(job.result, catalog, practice_explainer(uploaded_file.getvalue(), catalog))
+                    show_timing_panel(job)
+                else:
+                    if job.error:
+                        show_job_error(job, "Error analyzing the template")
+                    st.error("Failed to analyze the template. Please try again.")
+
+        elif st.session_state.active_view == 'update' and session_job('update_job_id'):
+            job = session_job('update_job_id')
+            if wait_for_job(job):
+                if job.status == DONE and st.session_state.report_disabled:
+                    st.rerun()
+                if job.status == DONE:
+                    st.markdown("Well-Architected Review updated and a Milestone created")
+                    # Kept by the update for its milestone, so reruns don't fetch the answers again
+                    pillar_summaries, total_questions, answered_questions = summarize_risks(workload_id, lens_alias, job.result['milestone_number'])
+                    display_risk_summary(pillar_summaries, total_questions, answered_questions)
+                    show_timing_panel(job)
+                else:
+                    st.write(f"Error in updating workload: {job.error}")
+
+        # Display report download button
+        elif st.session_state.active_view == 'report' and session_job('report_job_id'):
+            job = session_job('report_job_id')
+            if wait_for_job(job):
+                if job.status == DONE:
+                    show_report_download(job.result)
+                    st.success("Report generated successfully. Click the download button above to save the PDF.")
+                    show_timing_panel(job)
+                else:
+                    show_job_error(job, "Error generating report")
 
     
 # Run the app
@@ -0,0 +1,109 @@
+import threading
+from metrics import instrument_client
+from rate_governor import get_rate_governor
+
+# Process-wide AWS clients. Each client is created on first use and then shared
+# by every session and worker thread (botocore clients are thread-safe), so
+# connections stay open between reruns and the adaptive retry mode throttles
+# the whole process instead of each session on its own. boto3 itself is only
+# imported when the first client is created, which keeps it off the app's startup path.
+
+DEFAULT_RETRY_MODE = 'adaptive'
+
+# (connect timeout, read timeout) in seconds; Bedrock generations can run for minutes
+service_timeouts = {
+    's3': (5, 60),
+    'bedrock-runtime': (5, 300),
+    'wellarchitected': (5, 30)
+}
+
+# Attempts made by botocore itself. Bedrock shards and WA updates also retry in
+# the app, so these stay low enough that the two layers don't multiply.
+service_max_attempts = {
+    's3': 5,
+    'bedrock-runtime': 2,
+    'wellarchitected': 4
+}
+
+MIN_POOL_CONNECTIONS = 10
+S3_TRANSFER_CONCURRENCY = 8
+
+
+def pool_sizes(settings, concurrency=None):
+    # Enough connections for every job running its widest fan-out at once
+    if concurrency is None:
+        concurrency = int(settings.get('job_max_workers', 4))
+    analysis_workers = int(settings.get('analysis_max_workers', 6))
+    wa_workers = max(int(settings.get('wa_max_workers', 6)), int(settings.get('wa_update_max_workers', 4)))
+    return {
+        's3': max(MIN_POOL_CONNECTIONS, 2 * S3_TRANSFER_CONCURRENCY),
+        'bedrock-runtime': max(MIN_POOL_CONNECTIONS, concurrency * analysis_workers),
+        'wellarchitected': max(MIN_POOL_CONNECTIONS, concurrency * wa_workers)
+    }
+
+
+def client_config(service_name, pool_size, retry_mode=DEFAULT_RETRY_MODE):
+    from botocore.config import Config
+    connect_timeout, read_timeout = service_timeouts.get(service_name, (5, 60))
+    return Config(
+        max_pool_connections=pool_size,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        tcp_keepalive=True,
+        retries={'mode': retry_mode, 'max_attempts': service_max_attempts.get(service_name, 4)}
+    )
+
+
+class ClientFactory:
+    def __init__(self, session_args, pool_sizes, retry_mode=DEFAULT_RETRY_MODE, rate_governor=None):
+        self.session_args = session_args
+        self.pool_sizes = pool_sizes
+        self.retry_mode = retry_mode
+        self.rate_governor = rate_governor
+        self._session = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def client(self, service_name):
+        with self._lock:
+            client = self._clients.get(service_name)
+            if client is None:
+                # Creating sessions and clients is not thread-safe, so it happens under the lock
+                if self._session is None:
+                    import boto3
+                    self._session = boto3.session.Session(**self.session_args)
+                pool_size = self.pool_sizes.get(service_name, MIN_POOL_CONNECTIONS)
+                client = self._session.client(service_name, config=client_config(service_name, pool_size, self.retry_mode))
+                # Every API call is counted, with its retries and throttles, in the metrics registry
+                instrument_client(client)
+                # WA Tool calls of all sessions share one set of rate limits
+                if service_name == 'wellarchitected' and self.rate_governor is not None:
+                    self.rate_governor.instrument_client(client)
+                self._clients[service_name] = client
+                print(f"Created {service_name} client ({pool_size} connections, {self.retry_mode} retries)")
+            return client
+
+
+_factories = {}
+_factories_lock = threading.Lock()
+
+
+def get_client_factory(settings, region_name=None, concurrency=None):
+    # One factory per region and credentials; settings use the same keys as the Streamlit secrets
+    session_args = {'region_name': region_name or settings.get('region')}
+    if settings.get('aws_access_key_id'):
+        session_args['aws_access_key_id'] = settings['aws_access_key_id']
+        session_args['aws_secret_access_key'] = settings['aws_secret_access_key']
+
+    key = (session_args['region_name'], session_args.get('aws_access_key_id'), concurrency)
+    with _factories_lock:
+        factory = _factories.get(key)
+        if factory is None:
+            factory = ClientFactory(
+                session_args,
+                pool_sizes(settings, concurrency),
+                settings.get('aws_retry_mode', DEFAULT_RETRY_MODE),
+                get_rate_governor(settings) if settings.get('wa_rate_governor', True) else None
+            )
+            _factories[key] = factory
+        return factory
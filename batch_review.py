@@ -0,0 +1,365 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python < 3.11
+    import tomli as tomllib
+from aws_clients import get_client_factory
+from catalog import Catalog, get_catalog
+from metrics import Trace, registry, stage, use_trace
+from result_cache import AnalysisCache, DEFAULT_CACHE_DIR, DEFAULT_HISTORY_DIR
+from template_parser import make_template_fetcher
+from wa_review import (
+    DEFAULT_LENS_ALIAS,
+    RiskSummary,
+    analyze_template,
+    applied_practices_from_analysis,
+    create_workload_milestone,
+    get_review_snapshot,
+    update_answers
+)
+
+# Headless batch review: runs the web app's analyze -> update -> milestone ->
+# risk summary pipeline for many templates across many workloads. One JSON
+# line is written per template as soon as it finishes, so an interrupted run
+# can be resumed without redoing (or paying Bedrock for) the finished ones.
+#
+#   python batch_review.py --templates templates/ --output results.jsonl
+#   python batch_review.py --manifest reviews.csv --workers 8 --dry-run
+
+template_extensions = ('.json', '.yaml', '.yml', '.template')
+
+
+def load_settings(secrets_path):
+    # Same keys as the Streamlit secrets; a missing file means environment/default credentials
+    settings = {}
+    if secrets_path and os.path.exists(secrets_path):
+        with open(secrets_path, 'rb') as f:
+            settings = tomllib.load(f)
+    elif secrets_path:
+        print(f"Secrets file {secrets_path} not found, using the default AWS credentials")
+    return settings
+
+
+def create_clients(settings, region, concurrency):
+    # Clients are shared by all worker threads; pools are sized for --workers reviews fanning out at once
+    factory = get_client_factory(settings, region or os.environ.get('AWS_REGION'), concurrency)
+    return factory.client('s3'), factory.client('bedrock-runtime'), factory.client('wellarchitected')
+
+
+def load_review_catalog(args, settings, s3_client):
+    if args.catalog_s3_key:
+        return get_catalog(s3_client, settings['s3_bucket'], args.catalog_s3_key)
+    with open(args.catalog, encoding='utf-8') as f:
+        return Catalog(f.read())
+
+
+def read_manifest(manifest_path, default_workload_id):
+    # CSV with template,workload_id columns or a JSON list of {"template": ..., "workload_id": ...}
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding='utf-8') as f:
+        if manifest_path.lower().endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+
+    items = []
+    for row in rows:
+        template_path = row['template'].strip()
+        if not os.path.isabs(template_path):
+            template_path = os.path.join(base_dir, template_path)
+        workload_id = (row.get('workload_id') or '').strip() or default_workload_id
+        items.append((template_path, workload_id))
+    return items
+
+
+def scan_templates(templates_dir, default_workload_id):
+    # Without --workload-id, templates in a sub-folder go to the workload named like the folder
+    items = []
+    for root, dirs, files in os.walk(templates_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(template_extensions):
+                continue
+            relative_dir = os.path.relpath(root, templates_dir)
+            workload_id = default_workload_id
+            if not workload_id and relative_dir != '.':
+                workload_id = relative_dir.split(os.sep)[0]
+            items.append((os.path.join(root, name), workload_id))
+    return items
+
+
+def run_mode(args):
+    if args.analyze_only:
+        return 'analyze_only'
+    return 'dry_run' if args.dry_run else 'review'
+
+
+def history_name(args, template_path):
+    # Relative to the manifest's folder or --templates, so the incremental history is found
+    # again whatever directory the CLI is started from
+    if args.manifest:
+        source_dir = os.path.dirname(os.path.abspath(args.manifest))
+    else:
+        source_dir = os.path.abspath(args.templates)
+    return os.path.relpath(os.path.abspath(template_path), source_dir).replace(os.sep, '/')
+
+
+def item_key(workload_id, template_path, template_hash, mode):
+    # The mode is part of the key: a dry run or analysis alone does not make a later full review done
+    return f"{workload_id}|{os.path.abspath(template_path)}|{template_hash}|{mode}"
+
+
+def completed_keys(output_path):
+    # Items already reviewed successfully by an earlier run of the same output file
+    keys = set()
+    if not os.path.exists(output_path):
+        return keys
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('status') == 'ok':
+                keys.add(record.get('key'))
+    return keys
+
+
+class BatchReviewer:
+    def __init__(self, args, settings, clients, catalog, analysis_cache, analysis_history=None):
+        self.args = args
+        self.settings = settings
+        self.s3_client, self.bedrock_client, self.wa_client = clients
+        self.catalog = catalog
+        self.analysis_cache = analysis_cache
+        self.analysis_history = analysis_history
+        self.lens_alias = settings.get('lens_alias', DEFAULT_LENS_ALIAS)
+        # Bedrock and the WA Tool are throttled per account, not per template
+        self.bedrock_slots = threading.Semaphore(args.bedrock_concurrency)
+        self.wa_slots = threading.Semaphore(args.wa_concurrency)
+        # Templates of the same workload must not plan against each other's stale answers
+        self.workload_locks = {}
+        self.workload_locks_lock = threading.Lock()
+
+    def workload_lock(self, workload_id):
+        with self.workload_locks_lock:
+            return self.workload_locks.setdefault(workload_id, threading.Lock())
+
+    def review(self, template_path, workload_id, template_body, template_hash):
+        mode = run_mode(self.args)
+        record = {
+            'key': item_key(workload_id, template_path, template_hash, mode),
+            'template': template_path,
+            'workload_id': workload_id,
+            'sha256': template_hash,
+            'mode': mode,
+            'status': 'ok',
+            'stage': None,
+            'error': None
+        }
+        # Stage timings, AWS calls and Bedrock tokens of this template only
+        trace = Trace()
+        with use_trace(trace):
+            self.run_stages(record, template_path, workload_id, template_body)
+        trace_summary = trace.summary()
+        record['timings'] = {name: stage_summary['seconds'] for name, stage_summary in trace_summary['stages'].items()}
+        record['counters'] = trace_summary['counters']
+        return record
+
+    def run_stages(self, record, template_path, workload_id, template_body):
+        try:
+            record['stage'] = 'analyze'
+            with self.bedrock_slots:
+                analysis_results = analyze_template(
+                    self.bedrock_client,
+                    self.catalog,
+                    template_body,
+                    self.settings,
+                    analysis_cache=self.analysis_cache,
+                    source=template_path,
+                    # Nested stacks: relative paths next to the template, or S3 URLs
+                    fetch_template=make_template_fetcher(
+                        self.s3_client,
+                        base_dir=os.path.dirname(os.path.abspath(template_path)),
+                        allowed_buckets=self.settings.get('nested_stack_buckets')
+                    ),
+                    # A new version of the template only re-checks what its changed resources affect
+                    analysis_history=self.analysis_history,
+                    history_key=f"{workload_id}/{history_name(self.args, template_path)}"
+                )
+            applied_practices = applied_practices_from_analysis(analysis_results or '', self.catalog)
+            record['applied_practices'] = [practice.id for practice in applied_practices]
+            if self.args.analyze_only:
+                record['stage'] = None
+                return
+
+            with self.workload_lock(workload_id):
+                record['stage'] = 'update'
+                with self.wa_slots:
+                    # Seeded from the snapshot the update is planned from, then kept current from the responses
+                    risk_summary = RiskSummary(get_review_snapshot(self.wa_client, workload_id, self.lens_alias, self.settings))
+                    plan, responses, errors = update_answers(
+                        self.wa_client,
+                        workload_id,
+                        self.lens_alias,
+                        analysis_results or '',
+                        self.catalog,
+                        self.settings,
+                        dry_run=self.args.dry_run
+                    )
+                record['planned_updates'] = len(plan)
+                record['updated_questions'] = len(responses)
+                if errors:
+                    record['failed_questions'] = {question_id: str(e) for question_id, e in errors.items()}
+                    raise RuntimeError(f"{len(errors)} of {len(plan)} answer updates failed")
+                if self.args.dry_run:
+                    record['stage'] = None
+                    return
+
+                record['stage'] = 'milestone'
+                with self.wa_slots:
+                    milestone_response = create_workload_milestone(self.wa_client, workload_id)
+                if milestone_response is None:
+                    raise RuntimeError("Milestone could not be created")
+                record['milestone_number'] = milestone_response.get('MilestoneNumber')
+
+                record['stage'] = 'summary'
+                with stage('risk_summary'):
+                    risk_summary.apply_responses(responses)
+                    pillar_summaries, total_questions, answered_questions = risk_summary.summary()
+                record['risks'] = {
+                    'answered': answered_questions,
+                    'total': total_questions,
+                    'high': sum(pillar['high'] for pillar in pillar_summaries.values()),
+                    'medium': sum(pillar['medium'] for pillar in pillar_summaries.values()),
+                    'pillars': pillar_summaries
+                }
+            record['stage'] = None
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = f"{type(e).__name__}: {e}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Review many CloudFormation templates against the Well-Architected Framework.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='CSV (template,workload_id) or JSON list of templates to review')
+    source.add_argument('--templates', help='Directory of templates; sub-folder names are used as workload ids')
+    parser.add_argument('--workload-id', help='Workload for templates without one (defaults to workload_id in the secrets)')
+    parser.add_argument('--secrets', default=os.path.join('.streamlit', 'secrets.toml'), help='TOML file with the same keys as the Streamlit secrets')
+    parser.add_argument('--region', help='AWS region (defaults to region in the secrets or AWS_REGION)')
+    parser.add_argument('--catalog', default='well_architected_best_practices.json', help='Local best practices file')
+    parser.add_argument('--catalog-s3-key', help='Read the best practices file from s3_bucket instead of --catalog')
+    parser.add_argument('--output', default='batch_review_results.jsonl', help='JSON lines file; finished items in it are skipped')
+    parser.add_argument('--workers', type=int, default=4, help='Templates reviewed at the same time')
+    parser.add_argument('--bedrock-concurrency', type=int, default=2, help='Templates analyzed by Bedrock at the same time')
+    parser.add_argument('--wa-concurrency', type=int, default=2, help='Concurrent WA Tool stages across all workloads')
+    parser.add_argument('--dry-run', action='store_true', help='Analyze and plan answer updates without writing them')
+    parser.add_argument('--analyze-only', action='store_true', help='Only run the Bedrock analysis')
+    parser.add_argument('--metrics-file', help='Write Prometheus-style metrics (stage times, AWS calls, tokens) to this file')
+    parser.add_argument('--no-resume', action='store_true', help='Review every item again even if it is in --output')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = load_settings(args.secrets)
+    default_workload_id = args.workload_id or settings.get('workload_id')
+
+    if args.manifest:
+        items = read_manifest(args.manifest, default_workload_id)
+    else:
+        items = scan_templates(args.templates, default_workload_id)
+    if not args.analyze_only:
+        missing = [template_path for template_path, workload_id in items if not workload_id]
+        if missing:
+            print(f"No workload id for {len(missing)} templates, e.g. {missing[0]}; use --workload-id")
+            return 2
+
+    clients = create_clients(settings, args.region, args.workers)
+    catalog = load_review_catalog(args, settings, clients[0])
+    analysis_cache = AnalysisCache(
+        cache_dir=settings.get('analysis_cache_dir', DEFAULT_CACHE_DIR),
+        max_bytes=int(settings.get('analysis_cache_max_mb', 50)) * 1024 * 1024,
+        max_age_seconds=int(settings.get('analysis_cache_max_age_hours', 168)) * 60 * 60
+    )
+    analysis_history = AnalysisCache(
+        cache_dir=settings.get('analysis_history_dir', DEFAULT_HISTORY_DIR),
+        max_age_seconds=int(settings.get('analysis_history_max_age_hours', 720)) * 60 * 60
+    )
+    reviewer = BatchReviewer(args, settings, clients, catalog, analysis_cache, analysis_history)
+
+    done = set() if args.no_resume else completed_keys(args.output)
+    output_lock = threading.Lock()
+    counts = {'ok': 0, 'error': 0, 'skipped': 0}
+
+    def write_record(record):
+        record['finished'] = datetime.now().isoformat(timespec='seconds')
+        with output_lock:
+            output_file.write(json.dumps(record) + '\n')
+            output_file.flush()
+            counts[record['status']] += 1
+            if args.metrics_file:
+                registry.write_prometheus(args.metrics_file)
+        print(f"[{record['status']}] {record['workload_id']} {record['template']}"
+              + (f" ({record['stage']}: {record['error']})" if record['error'] else ''))
+
+    def run_item(template_path, workload_id):
+        try:
+            with open(template_path, 'rb') as f:
+                template_body = f.read()
+        except OSError as e:
+            return {'key': None, 'template': template_path, 'workload_id': workload_id, 'status': 'error',
+                    'stage': 'read', 'error': f"{type(e).__name__}: {e}"}
+        template_hash = hashlib.sha256(template_body).hexdigest()
+        if item_key(workload_id, template_path, template_hash, run_mode(args)) in done:
+            return None
+        return reviewer.review(template_path, workload_id, template_body, template_hash)
+
+    started = time.time()
+    with open(args.output, 'a', encoding='utf-8') as output_file:
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        futures = [executor.submit(run_item, template_path, workload_id) for template_path, workload_id in items]
+        pending = set(futures)
+
+        def collect(future):
+            pending.discard(future)
+            record = future.result()
+            if record is None:
+                counts['skipped'] += 1
+            else:
+                write_record(record)
+
+        try:
+            for future in as_completed(futures):
+                collect(future)
+        except KeyboardInterrupt:
+            # Let running reviews finish and record them; rerun to pick up the rest
+            print("Interrupted, waiting for running reviews to finish...")
+            executor.shutdown(wait=True, cancel_futures=True)
+            for future in list(pending):
+                if future.done() and not future.cancelled():
+                    collect(future)
+            return 130
+        executor.shutdown()
+
+    print(f"Reviewed {len(items)} templates in {time.time() - started:.1f}s: "
+          f"{counts['ok']} ok, {counts['error']} failed, {counts['skipped']} already done")
+    print(f"Analysis cache: {analysis_cache.stats()}")
+    if args.metrics_file:
+        registry.write_prometheus(args.metrics_file)
+    return 1 if counts['error'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
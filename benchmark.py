@@ -0,0 +1,517 @@
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from botocore.exceptions import ClientError
+from streamlit import config as streamlit_config
+from rate_governor import DEFAULT_RATE_LIMITS, RateGovernor
+
+# Offline benchmarks for the review pipeline. The real functions (the analysis,
+# display_result, update_review and summarize_risks from app.py) run against
+# in-process stand-ins for S3, Bedrock and the Well-Architected Tool with
+# configurable latency, page size and throttling. Every run appends one JSON
+# line to --output so results can be compared over time.
+#
+#   python benchmark.py
+#   python benchmark.py --catalog-scales 1,4 --template-scales 1,20 --wa-latency 0.05 --repeat 5
+#   python benchmark.py --startup --startup-budget 0.5
+
+pillar_ids = {
+    'Operational Excellence': 'operationalExcellence',
+    'Security': 'security',
+    'Reliability': 'reliability',
+    'Performance Efficiency': 'performance',
+    'Cost Optimization': 'costOptimization',
+    'Sustainability': 'sustainability'
+}
+
+
+class FakeService:
+    def __init__(self, latency=0.0, throttle_rate=0.0, throttle_operations=(), seed=0, quota=0.0, rate_governor=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttle_operations = set(throttle_operations)
+        # Requests per second per operation accepted before throttling, like a service quota (0: unlimited)
+        self.quota = quota
+        # Stands in for the before-send hook the real clients get from the rate governor
+        self.rate_governor = rate_governor
+        self.calls = {}
+        self.throttled = 0
+        self._quota_buckets = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _over_quota(self, operation):
+        now = time.monotonic()
+        tokens, updated = self._quota_buckets.get(operation, (self.quota, now))
+        tokens = min(self.quota, tokens + (now - updated) * self.quota)
+        if tokens < 1:
+            self._quota_buckets[operation] = (tokens, now)
+            return True
+        self._quota_buckets[operation] = (tokens - 1, now)
+        return False
+
+    def _call(self, operation):
+        if self.rate_governor is not None:
+            self.rate_governor.acquire(operation)
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            throttled = operation in self.throttle_operations and self._random.random() < self.throttle_rate
+            if self.quota and self._over_quota(operation):
+                throttled = True
+            if throttled:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    def call_counts(self):
+        with self._lock:
+            return dict(self.calls)
+
+
+class FakeS3(FakeService):
+    def __init__(self, objects, **kwargs):
+        super().__init__(**kwargs)
+        self.objects = objects
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self._call('GetObject')
+        body = self.objects[Key]
+        etag = f'"{hash(body) & 0xffffffff:x}"'
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+
+class FakeBedrock(FakeService):
+    def __init__(self, applied_every=3, token_latency=0.0, uncertain_every=7, fast_models=('haiku',), **kwargs):
+        super().__init__(**kwargs)
+        self.applied_every = applied_every
+        # Generation time per output token, on top of the fixed latency of a call
+        self.token_latency = token_latency
+        # Asked to flag uncertain practices, every uncertain_every-th practice comes back with "? "
+        self.uncertain_every = uncertain_every
+        # Model ids containing one of these generate four times as fast
+        self.fast_models = fast_models
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self._call('InvokeModel')
+        prompt = ''.join(block['text'] for block in json.loads(body)['messages'][0]['content'])
+        best_practices = json.loads(prompt[prompt.index('Best Practices:') + len('Best Practices:'):prompt.index('For each best practice')])
+        names = [name for entry in best_practices for name in entry['Best Practice']]
+        # Deterministic subset so every run "finds" the same practices
+        applied = [name for index, name in enumerate(names) if index % self.applied_every == 0]
+        uncertain = []
+        if 'starting with "? "' in prompt:
+            uncertain = [name for index, name in enumerate(names) if index % self.uncertain_every == 1]
+        if 'respond with its id only' in prompt:
+            lines = [name.split(' ')[0] for name in applied] + [f"? {name.split(' ')[0]}" for name in uncertain]
+        else:
+            lines = ([f"[{name}]: Found in the template, based on the resources that implement it" for name in applied]
+                     + [f"? [{name}]: Depends on settings outside the template" for name in uncertain])
+        text = '\n'.join(lines)
+        output_tokens = len(text) // 4
+        token_latency = self.token_latency
+        if any(fast_model in modelId for fast_model in self.fast_models):
+            token_latency /= 4
+        if token_latency:
+            time.sleep(output_tokens * token_latency)
+        response_body = {
+            'content': [{'type': 'text', 'text': text}],
+            'usage': {'input_tokens': len(prompt) // 4, 'output_tokens': output_tokens}
+        }
+        return {'body': io.BytesIO(json.dumps(response_body).encode('utf-8'))}
+
+
+class FakeWellArchitected(FakeService):
+    def __init__(self, catalog_entries, extra_answers=0, page_size=50, **kwargs):
+        super().__init__(**kwargs)
+        self.page_size = page_size
+        self.answers = {}
+        for entry in catalog_entries:
+            question_id, _, question_title = entry['Question'].partition(' - ')
+            choices = [
+                {'ChoiceId': f"{question_id.lower()}_c{index}", 'Title': ' '.join(name.split(' ')[1:])}
+                for index, name in enumerate(entry['Best Practice'])
+            ]
+            self._add_answer(question_id.lower(), pillar_ids.get(entry['Pillar'], 'unknown'), question_title, choices)
+        # Questions the analysis never touches, to vary the answer count on its own
+        for pillar_id in pillar_ids.values():
+            for index in range(extra_answers):
+                question_id = f"{pillar_id}_extra{index}"
+                choices = [{'ChoiceId': f"{question_id}_c{choice}", 'Title': f"Extra choice {choice}"} for choice in range(5)]
+                self._add_answer(question_id, pillar_id, f"Extra question {index} for {pillar_id}?", choices)
+
+    def _add_answer(self, question_id, pillar_id, question_title, choices):
+        self.answers[question_id] = {
+            'QuestionId': question_id,
+            'PillarId': pillar_id,
+            'QuestionTitle': question_title,
+            'Choices': choices,
+            'SelectedChoices': [],
+            'Risk': 'UNANSWERED'
+        }
+
+    def get_lens_review(self, WorkloadId, LensAlias, **kwargs):
+        self._call('GetLensReview')
+        return {'LensReview': {'PillarReviewSummaries': [
+            {'PillarId': pillar_id, 'PillarName': pillar_name} for pillar_name, pillar_id in pillar_ids.items()
+        ]}}
+
+    def list_answers(self, WorkloadId, LensAlias, PillarId, NextToken=None, **kwargs):
+        self._call('ListAnswers')
+        answers = [answer for answer in self.answers.values() if answer['PillarId'] == PillarId]
+        start = int(NextToken or 0)
+        response = {'AnswerSummaries': [copy.deepcopy(answer) for answer in answers[start:start + self.page_size]]}
+        if start + self.page_size < len(answers):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+    def update_answer(self, WorkloadId, LensAlias, QuestionId, SelectedChoices, **kwargs):
+        self._call('UpdateAnswer')
+        with self._lock:
+            answer = self.answers[QuestionId]
+            answer['SelectedChoices'] = list(SelectedChoices)
+            answer['Risk'] = 'MEDIUM' if len(SelectedChoices) < len(answer['Choices']) else 'NONE'
+            return {'Answer': copy.deepcopy(answer)}
+
+    def create_milestone(self, WorkloadId, **kwargs):
+        self._call('CreateMilestone')
+        return {'WorkloadId': WorkloadId, 'MilestoneNumber': 1}
+
+
+def quota_governor(quota):
+    # Sized to the simulated quota, as wa_rate_limits would be to the real one
+    return RateGovernor({operation: quota for operation in DEFAULT_RATE_LIMITS}, default_limit=(quota, quota))
+
+
+class FakeClientFactory:
+    def __init__(self, clients):
+        self.clients = clients
+
+    def client(self, service_name):
+        return self.clients[service_name]
+
+
+def scale_catalog(entries, scale):
+    # Copy every question (and its best practices) under a new id per extra copy
+    scaled = list(entries)
+    for copy_index in range(2, scale + 1):
+        for entry in entries:
+            question_id, _, question_title = entry['Question'].partition(' - ')
+            scaled.append({
+                'Pillar': entry['Pillar'],
+                'Question': f"{question_id}X{copy_index} - {question_title} (copy {copy_index})",
+                'Best Practice': [
+                    f"{name.split(' ')[0].rstrip(':')}X{copy_index} {' '.join(name.split(' ')[1:])} (copy {copy_index})"
+                    for name in entry['Best Practice']
+                ]
+            })
+    return scaled
+
+
+def scale_template(template, scale):
+    # Repeat every resource under a new logical id; references keep pointing at the originals
+    scaled = copy.deepcopy(template)
+    resources = template.get('Resources', {})
+    for copy_index in range(2, scale + 1):
+        for logical_id, resource in resources.items():
+            scaled['Resources'][f"{logical_id}Copy{copy_index}"] = copy.deepcopy(resource)
+    return scaled
+
+
+benchmark_secrets = {
+    'aws_access_key_id': 'benchmark',
+    'aws_secret_access_key': 'benchmark',
+    'region': 'us-east-1',
+    'workload_id': 'wl-benchmark',
+    's3_bucket': 'benchmark',
+    'catalog_refresh_seconds': 0,
+    'wa_snapshot_ttl_seconds': 60,
+    # The fake WA Tool has no reports, and a background report job would skew the timed steps
+    'report_prefetch': False
+}
+
+
+def write_secrets(settings):
+    secrets_path = os.path.join(tempfile.mkdtemp(prefix='wa-benchmark-'), 'secrets.toml')
+    with open(secrets_path, 'w', encoding='utf-8') as f:
+        for key, value in settings.items():
+            f.write(f"{key} = {json.dumps(value)}\n")
+    return secrets_path
+
+
+def load_app(settings):
+    # app.py reads st.secrets at import time, so point Streamlit at a throwaway secrets file first
+    logging.getLogger('streamlit').setLevel(logging.ERROR)
+    streamlit_config.set_option('secrets.files', [write_secrets(settings)])
+    import app
+    return app
+
+
+# Cold start of one server process, run in a fresh interpreter per sample:
+# importing Streamlit, importing app.py and the first script run of the page
+# (what a new user sees first), plus which heavy optional modules got loaded.
+startup_probe = '''
+import json, logging, sys, time
+started = time.perf_counter()
+from streamlit import config as streamlit_config
+logging.getLogger('streamlit').setLevel(logging.ERROR)
+streamlit_config.set_option('secrets.files', [sys.argv[1]])
+sys.path.insert(0, sys.argv[2])
+imported_streamlit = time.perf_counter()
+import app
+imported_app = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+page = AppTest.from_file(app.__file__, default_timeout=60)
+created = time.perf_counter()
+page.run()
+rendered = time.perf_counter()
+print(json.dumps({
+    'streamlit_import': imported_streamlit - started,
+    'app_import': imported_app - imported_streamlit,
+    'first_render': rendered - created,
+    'errors': [str(element.value) for element in page.exception],
+    'heavy_modules': [name for name in sys.argv[3].split(',') if name in sys.modules]
+}))
+'''
+
+startup_heavy_modules = ['pandas', 'numpy', 'boto3', 'yaml']
+
+
+def run_startup_benchmark(args):
+    secrets_path = write_secrets(benchmark_secrets)
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(args.startup_runs):
+        completed = subprocess.run(
+            [sys.executable, '-c', startup_probe, secrets_path, app_dir, ','.join(startup_heavy_modules)],
+            capture_output=True, text=True, check=True
+        )
+        sample = json.loads(completed.stdout.strip().splitlines()[-1])
+        if sample['errors']:
+            raise RuntimeError(f"First render failed: {sample['errors']}")
+        samples.append(sample)
+
+    rows = []
+    for name in ('streamlit_import', 'app_import', 'first_render'):
+        seconds = [sample[name] for sample in samples]
+        rows.append({
+            'step': name,
+            'seconds_median': round(statistics.median(seconds), 4),
+            'seconds_min': round(min(seconds), 4),
+            'seconds_max': round(max(seconds), 4)
+        })
+        print(f"{name:16} {rows[-1]['seconds_median']:8.4f}s  (min {rows[-1]['seconds_min']:.4f}s, max {rows[-1]['seconds_max']:.4f}s)",
+              file=sys.stderr)
+    # Streamlit's own import is paid by any page; the budget covers what app.py adds
+    startup_seconds = rows[1]['seconds_median'] + rows[2]['seconds_median']
+    heavy_modules = samples[0]['heavy_modules']
+    rows.append({
+        'step': 'startup',
+        'seconds_median': round(startup_seconds, 4),
+        'budget_seconds': args.startup_budget,
+        'within_budget': startup_seconds <= args.startup_budget,
+        'heavy_modules': heavy_modules
+    })
+    print(f"startup          {startup_seconds:8.4f}s  budget {args.startup_budget}s  "
+          f"{'ok' if startup_seconds <= args.startup_budget else 'OVER BUDGET'}  heavy modules loaded: {heavy_modules or 'none'}",
+          file=sys.stderr)
+    return rows
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_steps(app, args, catalog_key, catalog_entries, template_body, extra_answers, measure_memory):
+    from wa_review import analyze_template
+    from wa_snapshot import invalidate_snapshot
+
+    fakes = {
+        's3': FakeS3({catalog_key: json.dumps(catalog_entries).encode('utf-8')}, latency=args.s3_latency),
+        'bedrock-runtime': FakeBedrock(latency=args.bedrock_latency, token_latency=args.bedrock_token_latency),
+        'wellarchitected': FakeWellArchitected(
+            catalog_entries,
+            extra_answers=extra_answers,
+            page_size=args.page_size,
+            latency=args.wa_latency,
+            throttle_rate=args.throttle_rate,
+            throttle_operations=args.throttle_operations.split(','),
+            quota=args.wa_quota,
+            rate_governor=quota_governor(args.wa_quota) if args.wa_rate_governor and args.wa_quota else None
+        )
+    }
+    app.client_factory = FakeClientFactory(fakes)
+    invalidate_snapshot(app.workload_id)
+    settings = {'rule_engine_mode': args.rule_engine_mode, 'analysis_max_workers': args.analysis_workers,
+                'analysis_output_mode': args.output_mode}
+    if args.triage_model_id:
+        settings['triage_model_id'] = args.triage_model_id
+
+    state = {}
+
+    def step_catalog():
+        state['catalog'] = app.load_catalog(catalog_key)
+
+    def step_analysis():
+        state['analysis'] = analyze_template(fakes['bedrock-runtime'], state['catalog'], template_body, settings)
+
+    def step_display():
+        # First paint of a new analysis; display_rerun is the repaint on every later rerun
+        app.st.session_state.pop('result_model', None)
+        app.display_result(state['analysis'], state['catalog'])
+
+    def step_display_rerun():
+        app.display_result(state['analysis'], state['catalog'])
+
+    def step_update():
+        state['milestone_number'] = app.update_review(state['analysis'], state['catalog'], app.review_settings())
+
+    def step_summary():
+        app.summarize_risks(app.workload_id, app.lens_alias, state['milestone_number'])
+
+    results = {}
+    for name, function in [('catalog_load', step_catalog), ('analysis', step_analysis), ('display_result', step_display),
+                           ('display_rerun', step_display_rerun), ('update_review', step_update),
+                           ('summarize_risks', step_summary)]:
+        calls_before = {service: fake.call_counts() for service, fake in fakes.items()}
+        throttled_before = sum(fake.throttled for fake in fakes.values())
+        if measure_memory:
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - started
+        calls = {}
+        for service, fake in fakes.items():
+            for operation, total in fake.call_counts().items():
+                made = total - calls_before[service].get(operation, 0)
+                if made:
+                    calls[operation] = made
+        results[name] = {'seconds': seconds, 'api_calls': calls,
+                         'throttled': sum(fake.throttled for fake in fakes.values()) - throttled_before}
+        if measure_memory:
+            results[name]['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    results['_answers'] = len(fakes['wellarchitected'].answers)
+    return results
+
+
+def run_benchmarks(args):
+    app = load_app(benchmark_secrets)
+    with open(args.catalog, encoding='utf-8') as f:
+        base_catalog = json.load(f)
+    with open(args.template, encoding='utf-8') as f:
+        base_template = json.load(f)
+
+    rows = []
+    for catalog_scale in [int(value) for value in args.catalog_scales.split(',')]:
+        catalog_entries = scale_catalog(base_catalog, catalog_scale)
+        practice_count = sum(len(entry['Best Practice']) for entry in catalog_entries)
+        for template_scale in [int(value) for value in args.template_scales.split(',')]:
+            template = scale_template(base_template, template_scale)
+            template_body = json.dumps(template, indent=2).encode('utf-8')
+            for extra_answers in [int(value) for value in args.extra_answers.split(',')]:
+                catalog_key = f"benchmark-catalog-x{catalog_scale}.json"
+                timings = {}
+                for _ in range(args.repeat):
+                    runs = run_steps(app, args, catalog_key, catalog_entries, template_body, extra_answers, False)
+                    for name, result in runs.items():
+                        if not name.startswith('_'):
+                            timings.setdefault(name, []).append(result['seconds'])
+                # One more pass under tracemalloc: memory only, it slows everything down
+                tracemalloc.start()
+                memory_run = run_steps(app, args, catalog_key, catalog_entries, template_body, extra_answers, True)
+                tracemalloc.stop()
+
+                for name, seconds in timings.items():
+                    row = {
+                        'step': name,
+                        'catalog_scale': catalog_scale,
+                        'best_practices': practice_count,
+                        'template_scale': template_scale,
+                        'resources': len(template['Resources']),
+                        'template_bytes': len(template_body),
+                        'answers': memory_run['_answers'],
+                        'seconds_median': round(statistics.median(seconds), 4),
+                        'seconds_min': round(min(seconds), 4),
+                        'seconds_max': round(max(seconds), 4),
+                        'api_calls': memory_run[name]['api_calls'],
+                        'throttled': memory_run[name]['throttled'],
+                        'peak_memory_kb': memory_run[name]['peak_memory_kb']
+                    }
+                    rows.append(row)
+                    print(f"{name:16} catalog x{catalog_scale:<3} template x{template_scale:<3} answers {row['answers']:<5} "
+                          f"{row['seconds_median']:8.4f}s  calls {sum(row['api_calls'].values()):<4} throttled {row['throttled']:<3} "
+                          f"peak {row['peak_memory_kb']} KB", file=sys.stderr)
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the review pipeline against in-process AWS fakes.')
+    parser.add_argument('--catalog', default='well_architected_best_practices.json')
+    parser.add_argument('--template', default='sample-3-tier-app.json')
+    parser.add_argument('--catalog-scales', default='1,2', help='Comma-separated catalog size multipliers')
+    parser.add_argument('--template-scales', default='1,10', help='Comma-separated template size multipliers')
+    parser.add_argument('--extra-answers', default='0', help='Comma-separated counts of extra WA questions per pillar')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per scenario (the median is reported)')
+    parser.add_argument('--wa-latency', type=float, default=0.01, help='Seconds added to every WA Tool call')
+    parser.add_argument('--bedrock-latency', type=float, default=0.2, help='Seconds added to every Bedrock call')
+    parser.add_argument('--bedrock-token-latency', type=float, default=0.001, help='Seconds per generated output token')
+    parser.add_argument('--s3-latency', type=float, default=0.01, help='Seconds added to every S3 call')
+    parser.add_argument('--page-size', type=int, default=50, help='list_answers page size')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of throttled calls for --throttle-operations')
+    parser.add_argument('--throttle-operations', default='UpdateAnswer', help='Comma-separated operations that can be throttled')
+    parser.add_argument('--wa-quota', type=float, default=0.0,
+                        help='WA Tool requests per second per operation before the fake throttles (0: unlimited)')
+    parser.add_argument('--wa-rate-governor', action='store_true', help='Pace WA Tool calls to --wa-quota with the rate governor')
+    parser.add_argument('--rule-engine-mode', default='assist')
+    parser.add_argument('--analysis-workers', type=int, default=6)
+    parser.add_argument('--output-mode', default='compact', help='analysis_output_mode: compact or reasons')
+    parser.add_argument('--triage-model-id', default='', help='Route the analysis through this model first, e.g. a Haiku model id')
+    parser.add_argument('--startup', action='store_true', help='Measure the cold start of app.py instead of the review steps')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Fresh interpreters started for --startup (the median is reported)')
+    parser.add_argument('--startup-budget', type=float, default=0.5,
+                        help='Seconds allowed for importing app.py plus its first render; exceeding it makes --startup exit with 1')
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='Each run is appended as one JSON line')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = datetime.now()
+    rows = run_startup_benchmark(args) if args.startup else run_benchmarks(args)
+    run = {
+        'started': started.isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': rows
+    }
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f"Wrote {len(rows)} results to {args.output}", file=sys.stderr)
+    if args.startup and not rows[-1]['within_budget']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import difflib
+import json
+import re
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from botocore.exceptions import ClientError
+
+# Process-wide, immutable index of the Well-Architected best practices catalog.
+# The catalog is downloaded and parsed once per process and shared by every
+# session; S3 is only asked again (with If-None-Match) after refresh_seconds.
+
+DEFAULT_REFRESH_SECONDS = 300
+
+# Minimum similarity for matching a paraphrased practice title (difflib ratio)
+DEFAULT_TITLE_CUTOFF = 0.85
+
+# "[REL09-BP02 Secure and encrypt backups]: reason", one per line; the reason must not be empty
+analysis_line_pattern = re.compile(r'^\s*[-*]?\s*\[([^\]\n]+)\]:[ \t]*(\S[^\n]*)$', re.MULTILINE)
+
+# REL09-BP02, also as REL9-BP2 or rel09-bp02
+practice_id_pattern = re.compile(r'\b([A-Za-z]{2,5})\s?(\d{1,2})-BP(\d{1,2})\b', re.IGNORECASE)
+
+BestPractice = namedtuple('BestPractice', [
+    'id',                # COST01-BP01
+    'name',              # COST01-BP01 Establish ownership of cost optimization
+    'pillar',            # Cost Optimization
+    'question',          # COST1 - How do you implement cloud financial management?
+    'question_title',    # How do you implement cloud financial management?
+    'title',             # Establish ownership of cost optimization (the WA choice title)
+    'normalized_title'   # establish ownership of cost optimization
+])
+
+
+def normalize_title(text):
+    return ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+
+
+def practice_id_from_name(name):
+    # "OPS07-BP02: Ensure ..." -> "OPS07-BP02"
+    return name.split(' ')[0].rstrip(':')
+
+
+def find_practice_id(text):
+    # Canonical id mentioned in text, e.g. "rel9-bp2 ..." -> "REL09-BP02"
+    match = practice_id_pattern.search(text)
+    if not match:
+        return None
+    prefix, question_number, practice_number = match.groups()
+    return f"{prefix.upper()}{int(question_number):02d}-BP{int(practice_number):02d}"
+
+
+def parse_analysis(text):
+    # [(label, reason)] for every "[label]: reason" line of the model output
+    return [(label.strip(), reason.strip()) for label, reason in analysis_line_pattern.findall(text or '')]
+
+
+class Catalog:
+    def __init__(self, content, etag=None):
+        self.content = content
+        self.etag = etag
+        entries = json.loads(content)
+
+        practices = []
+        pillars = {}
+        for entry in entries:
+            pillar = entry.get('Pillar', 'Unknown')
+            question = entry.get('Question', 'Unknown')
+            question_title = question.partition(' - ')[2]
+            question_practices = pillars.setdefault(pillar, {}).setdefault(question, [])
+            for name in entry.get('Best Practice', []):
+                name = name.strip()
+                title = ' '.join(name.split(' ')[1:]).strip()
+                practice = BestPractice(practice_id_from_name(name), name, pillar, question, question_title,
+                                        title, normalize_title(title))
+                practices.append(practice)
+                question_practices.append(practice)
+
+        self.practices = tuple(practices)
+        self.by_id = MappingProxyType({practice.id: practice for practice in practices})
+        self.by_name = MappingProxyType({practice.name: practice for practice in practices})
+        by_normalized_title = {}
+        for practice in practices:
+            # A few titles repeat across pillars; the first one keeps the title
+            by_normalized_title.setdefault(practice.normalized_title, practice)
+        self.by_normalized_title = MappingProxyType(by_normalized_title)
+        self.normalized_titles = tuple(self.by_normalized_title)
+        question_practices_by_title = {}
+        for practice in practices:
+            question_practices_by_title.setdefault(normalize_title(practice.question_title), []).append(practice)
+        self.by_question_title = MappingProxyType({
+            question_title: tuple(items) for question_title, items in question_practices_by_title.items()
+        })
+        self.pillars = MappingProxyType({
+            pillar: MappingProxyType({question: tuple(items) for question, items in questions.items()})
+            for pillar, questions in pillars.items()
+        })
+
+    def resolve_practice(self, label, cutoff=DEFAULT_TITLE_CUTOFF):
+        # Id first (stable even when the model rewords the title), then the exact
+        # name, the normalized title and finally the closest title above cutoff
+        practice_id = find_practice_id(label)
+        if practice_id in self.by_id:
+            return self.by_id[practice_id]
+        practice = self.by_name.get(label.strip())
+        if practice:
+            return practice
+        title = practice_id_pattern.sub(' ', label)
+        normalized = normalize_title(title)
+        practice = self.by_normalized_title.get(normalized)
+        if practice or not normalized:
+            return practice
+        close_matches = difflib.get_close_matches(normalized, self.normalized_titles, n=1, cutoff=cutoff)
+        return self.by_normalized_title[close_matches[0]] if close_matches else None
+
+    def match_analysis(self, text):
+        # [(BestPractice, reason)] in output order, first mention of each practice wins
+        matched = []
+        seen = set()
+        for label, reason in parse_analysis(text):
+            practice = self.resolve_practice(label)
+            if practice is None:
+                print(f"Could not match best practice from the analysis: {label}")
+                continue
+            if practice.id in seen:
+                continue
+            seen.add(practice.id)
+            matched.append((practice, reason))
+        return matched
+
+    def best_practices(self):
+        # Fresh copy of the JSON entries, in the shape the analysis prompt uses
+        return [
+            {'Pillar': pillar, 'Question': question, 'Best Practice': [practice.name for practice in practices]}
+            for pillar, questions in self.pillars.items()
+            for question, practices in questions.items()
+        ]
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(s3_client, bucket, key, refresh_seconds=DEFAULT_REFRESH_SECONDS):
+    with _catalogs_lock:
+        cached = _catalogs.get((bucket, key))
+        if cached and time.time() - cached['checked'] < refresh_seconds:
+            return cached['catalog']
+
+        params = {'Bucket': bucket, 'Key': key}
+        if cached:
+            params['IfNoneMatch'] = cached['catalog'].etag
+        try:
+            response = s3_client.get_object(**params)
+        except ClientError as e:
+            if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+                cached['checked'] = time.time()
+                return cached['catalog']
+            if cached:
+                # Keep serving the catalog we have rather than failing every request
+                print(f"Error refreshing best practices catalog, using cached copy: {e}")
+                cached['checked'] = time.time()
+                return cached['catalog']
+            raise
+
+        catalog = Catalog(response['Body'].read().decode('utf-8'), response.get('ETag'))
+        _catalogs[(bucket, key)] = {'catalog': catalog, 'checked': time.time()}
+        return catalog
@@ -0,0 +1,164 @@
+import hashlib
+import json
+from collections import namedtuple
+
+# Incremental re-analysis: the resources of the last analyzed version of each
+# template (per workload) are kept as fingerprints next to the model's findings.
+# A new version is diffed against them resource by resource, and only the best
+# practices whose questions the added, modified or removed resources can affect
+# go back to the model; the other findings are carried forward.
+
+ResourceChanges = namedtuple('ResourceChanges', ['added', 'modified', 'removed'])
+
+# Pseudo resource for the Parameters, Mappings, Conditions and Transform of a stack
+TEMPLATE_SECTIONS_TYPE = 'AWS::CloudFormation::Template'
+template_sections = ['Transform', 'Parameters', 'Mappings', 'Conditions']
+
+# WA questions a change to a resource type can affect. Looked up by exact type,
+# then by service (e.g. AWS::RDS); None means any question, i.e. a full re-analysis.
+affected_questions_by_type = {
+    TEMPLATE_SECTIONS_TYPE: None,
+    # Nested stacks are diffed through their own resources
+    'AWS::CloudFormation::Stack': [],
+    'AWS::EC2::SecurityGroup': ['SEC5', 'SEC6', 'REL2', 'PERF4'],
+    'AWS::EC2::SecurityGroupIngress': ['SEC5', 'SEC6'],
+    'AWS::EC2::SecurityGroupEgress': ['SEC5', 'SEC6'],
+    'AWS::EC2::Instance': ['SEC6', 'PERF2', 'REL7', 'REL11', 'COST6', 'COST7', 'SUS2', 'SUS5', 'OPS4'],
+    'AWS::EC2::LaunchTemplate': ['SEC6', 'PERF2', 'REL11', 'COST6', 'COST7', 'SUS5'],
+    'AWS::EC2::Volume': ['SEC8', 'REL9', 'PERF3', 'COST6'],
+    'AWS::EC2': ['SEC5', 'REL2', 'REL10', 'PERF4', 'COST8'],
+    'AWS::AutoScaling': ['REL7', 'REL10', 'REL11', 'PERF2', 'COST6', 'COST9', 'SUS2'],
+    'AWS::ApplicationAutoScaling': ['REL7', 'PERF2', 'COST9', 'SUS2'],
+    'AWS::ElasticLoadBalancing': ['REL10', 'REL11', 'PERF4', 'SEC9', 'REL7'],
+    'AWS::ElasticLoadBalancingV2': ['REL10', 'REL11', 'PERF4', 'SEC9', 'REL7'],
+    'AWS::RDS': ['SEC8', 'SEC9', 'REL9', 'REL10', 'REL11', 'REL13', 'PERF3', 'COST6', 'SUS4'],
+    'AWS::DynamoDB': ['SEC8', 'REL9', 'REL11', 'REL13', 'PERF3', 'COST6', 'SUS4'],
+    'AWS::DocDB': ['SEC8', 'SEC9', 'REL9', 'REL11', 'PERF3'],
+    'AWS::Neptune': ['SEC8', 'SEC9', 'REL9', 'REL11', 'PERF3'],
+    'AWS::Redshift': ['SEC8', 'SEC9', 'REL9', 'PERF3', 'COST6'],
+    'AWS::ElastiCache': ['SEC8', 'SEC9', 'REL11', 'PERF3'],
+    'AWS::EFS': ['SEC8', 'REL9', 'PERF3', 'SUS4'],
+    'AWS::S3': ['SEC7', 'SEC8', 'SEC9', 'REL9', 'REL13', 'PERF3', 'COST4', 'COST8', 'SUS4'],
+    'AWS::Backup': ['REL9', 'REL13'],
+    'AWS::IAM': ['SEC2', 'SEC3'],
+    'AWS::Cognito': ['SEC2', 'SEC3'],
+    'AWS::KMS': ['SEC7', 'SEC8', 'SEC9'],
+    'AWS::SecretsManager': ['SEC2', 'SEC8'],
+    'AWS::CertificateManager': ['SEC9'],
+    'AWS::WAFv2': ['SEC5', 'SEC6'],
+    'AWS::WAF': ['SEC5', 'SEC6'],
+    'AWS::Shield': ['SEC5', 'REL10'],
+    'AWS::CloudTrail': ['SEC4', 'SEC10', 'OPS8'],
+    'AWS::GuardDuty': ['SEC1', 'SEC4', 'SEC10'],
+    'AWS::Config': ['SEC1', 'SEC4', 'OPS8'],
+    'AWS::SecurityHub': ['SEC1', 'SEC4', 'SEC10'],
+    'AWS::CloudWatch': ['OPS4', 'OPS8', 'OPS10', 'REL6', 'PERF5', 'SEC4'],
+    'AWS::Logs': ['OPS4', 'OPS8', 'REL6', 'SEC4', 'SUS4'],
+    'AWS::SNS': ['OPS10', 'REL4', 'REL5', 'REL6'],
+    'AWS::SQS': ['REL3', 'REL4', 'REL5', 'SEC8'],
+    'AWS::Events': ['REL3', 'REL4', 'OPS10'],
+    'AWS::StepFunctions': ['REL3', 'REL4', 'REL5'],
+    'AWS::Kinesis': ['REL4', 'REL5', 'PERF3', 'SEC8'],
+    'AWS::Lambda': ['SEC6', 'PERF2', 'REL3', 'REL5', 'REL7', 'REL11', 'COST6', 'SUS2', 'SUS5'],
+    'AWS::Serverless': ['SEC6', 'PERF2', 'REL3', 'REL5', 'REL7', 'REL11', 'COST6', 'SUS2', 'SUS5'],
+    'AWS::ECS': ['SEC6', 'PERF2', 'REL3', 'REL7', 'REL11', 'COST6', 'SUS2', 'SUS5'],
+    'AWS::EKS': ['SEC6', 'PERF2', 'REL3', 'REL7', 'REL11', 'COST6', 'SUS2', 'SUS5'],
+    'AWS::ApiGateway': ['SEC5', 'SEC9', 'REL4', 'REL5', 'PERF4'],
+    'AWS::ApiGatewayV2': ['SEC5', 'SEC9', 'REL4', 'REL5', 'PERF4'],
+    'AWS::CloudFront': ['SEC5', 'SEC9', 'PERF3', 'PERF4', 'REL10', 'COST8'],
+    'AWS::Route53': ['REL2', 'REL10', 'REL13', 'PERF4'],
+    'AWS::GlobalAccelerator': ['REL2', 'REL10', 'PERF4'],
+    'AWS::CodePipeline': ['OPS5', 'OPS6', 'REL8', 'SEC11'],
+    'AWS::CodeBuild': ['OPS5', 'OPS6', 'REL8', 'SEC11'],
+    'AWS::CodeDeploy': ['OPS5', 'OPS6', 'REL8'],
+    'AWS::SSM': ['OPS5', 'OPS10', 'SEC1', 'SEC6'],
+    'AWS::Budgets': ['COST1', 'COST2', 'COST3'],
+    'AWS::CE': ['COST1', 'COST3'],
+    'AWS::ServiceQuotas': ['REL1']
+}
+
+# Questions about the architecture as a whole; any added or removed resource can change them
+any_change_questions = ['PERF1', 'COST5', 'SUS3']
+
+
+def fingerprint(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def with_fingerprints(stacks, fingerprints):
+    # Records {prefix + logical id: [type, hash]} while the stacks are being chunked
+    for prefix, template in stacks:
+        fingerprints[f"{prefix}(template)"] = [TEMPLATE_SECTIONS_TYPE, fingerprint([template.get(section) for section in template_sections])]
+        for logical_id, resource in (template.get('Resources') or {}).items():
+            if isinstance(resource, dict):
+                fingerprints[prefix + logical_id] = [resource.get('Type', 'Unknown'), fingerprint(resource)]
+        yield prefix, template
+
+
+def diff_resources(old_fingerprints, new_fingerprints):
+    # {resource id: type} for each kind of change
+    added = {}
+    modified = {}
+    for resource_id, (resource_type, resource_hash) in new_fingerprints.items():
+        old = old_fingerprints.get(resource_id)
+        if old is None:
+            added[resource_id] = resource_type
+        elif old[1] != resource_hash or old[0] != resource_type:
+            modified[resource_id] = resource_type
+    removed = {
+        resource_id: resource_type
+        for resource_id, (resource_type, _) in old_fingerprints.items() if resource_id not in new_fingerprints
+    }
+    return ResourceChanges(added, modified, removed)
+
+
+def questions_for_type(resource_type):
+    if resource_type in affected_questions_by_type:
+        return affected_questions_by_type[resource_type]
+    service = '::'.join(resource_type.split('::')[:2])
+    # Unknown services (custom resources, new AWS services) may touch anything
+    return affected_questions_by_type.get(service)
+
+
+def affected_questions(changes):
+    # Question ids (e.g. SEC5) to re-evaluate, or None for all of them
+    questions = set()
+    for changed in (changes.added, changes.modified, changes.removed):
+        for resource_type in changed.values():
+            type_questions = questions_for_type(resource_type)
+            if type_questions is None:
+                return None
+            questions.update(type_questions)
+    if changes.added or changes.removed:
+        questions.update(any_change_questions)
+    return questions
+
+
+def question_id(entry):
+    # "SEC5 - How do you protect your network resources?" -> "SEC5"
+    return entry.get('Question', '').partition(' - ')[0].strip()
+
+
+def split_best_practices(best_practices, questions, evaluated):
+    # (to_evaluate, carried_names): practices the model saw last time and whose
+    # question is unaffected keep their findings; everything else is evaluated
+    to_evaluate = []
+    carried_names = set()
+    for entry in best_practices:
+        if question_id(entry) in questions:
+            to_evaluate.append(entry)
+            continue
+        carried = [practice for practice in entry.get('Best Practice', []) if practice in evaluated]
+        new = [practice for practice in entry.get('Best Practice', []) if practice not in evaluated]
+        carried_names.update(carried)
+        if new:
+            to_evaluate.append(dict(entry, **{'Best Practice': new}))
+    return to_evaluate, carried_names
+
+
+def carry_forward_findings(findings, catalog, carried_names):
+    # The stored "[BP name]: reason" lines of the carried practices
+    return "\n".join(
+        f"[{practice.name}]: {reason}"
+        for practice, reason in catalog.match_analysis(findings or '') if practice.name in carried_names
+    )
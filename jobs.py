@@ -0,0 +1,151 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Trace, use_trace
+
+# Background jobs for the long review steps (analysis, WA Tool update, report).
+# One bounded pool per server process runs the jobs of every session; the
+# script thread only submits a job, keeps its id in session_state and polls
+# the job's status. Submitting a job whose dedup key matches a queued, running
+# or finished job returns that job instead, so a refresh or a second click
+# never repeats the work. Speculative jobs (e.g. a report prefetch) are claimed
+# by the first regular submit with the same dedup key; until then they can be
+# cancelled while they are still queued.
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_RETENTION_SECONDS = 60 * 60
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class Job:
+    def __init__(self, kind, dedup_key=None, speculative=False):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.dedup_key = dedup_key
+        self.speculative = speculative
+        self.status = QUEUED
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Stage timings, AWS calls and tokens of this job only
+        self.trace = Trace()
+        self._events = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.status in (QUEUED, RUNNING)
+
+    @property
+    def elapsed(self):
+        if not self.started:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def set_stage(self, stage):
+        self.stage = stage
+        print(f"Job {self.kind} {self.id[:8]}: {stage}")
+
+    def add_event(self, event):
+        # Partial results (e.g. streamed best practices) the UI can show before the job ends
+        with self._lock:
+            self._events.append(event)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+
+class JobRunner:
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, retention_seconds=DEFAULT_RETENTION_SECONDS, on_finish=None):
+        self.max_workers = max_workers
+        self.retention_seconds = retention_seconds
+        self.on_finish = on_finish
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wa-job')
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, function, *args, dedup_key=None, speculative=False, **kwargs):
+        # function(job, *args, **kwargs) runs on the pool; its return value becomes job.result
+        with self._lock:
+            self._prune()
+            if dedup_key is not None:
+                existing = self._jobs.get(self._by_key.get(dedup_key))
+                if existing and existing.status not in (FAILED, CANCELLED):
+                    if not speculative:
+                        existing.speculative = False
+                    return existing
+            job = Job(kind, dedup_key, speculative)
+            self._jobs[job.id] = job
+            if dedup_key is not None:
+                self._by_key[dedup_key] = job.id
+        self._executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel_speculative(self, matches):
+        # Cancels the queued speculative jobs whose dedup key matches; running ones finish
+        cancelled = 0
+        with self._lock:
+            for job in self._jobs.values():
+                if job.speculative and job.status == QUEUED and matches(job.dedup_key):
+                    job.status = CANCELLED
+                    job.finished = time.time()
+                    if self._by_key.get(job.dedup_key) == job.id:
+                        del self._by_key[job.dedup_key]
+                    cancelled += 1
+        return cancelled
+
+    def queue_position(self, job):
+        # How many jobs were submitted before this one and are still waiting
+        with self._lock:
+            return sum(other.status == QUEUED and other.created < job.created for other in self._jobs.values())
+
+    def _run(self, job, function, args, kwargs):
+        with self._lock:
+            if job.status == CANCELLED:
+                return
+            job.status = RUNNING
+        job.started = time.time()
+        result, status = None, DONE
+        try:
+            with use_trace(job.trace):
+                result = function(job, *args, **kwargs)
+        except Exception as e:
+            print(f"Job {job.kind} {job.id[:8]} failed: {e}")
+            traceback.print_exc()
+            job.error = e
+            status = FAILED
+        # finished is set before the status flips, so _prune never sees a finished job without it
+        with self._lock:
+            job.result = result
+            job.finished = time.time()
+            job.status = status
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                print(f"Error in job finish hook: {e}")
+
+    def _prune(self):
+        # Finished jobs are kept long enough for their sessions to pick up the result
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if not job.active and job.finished is not None and now - job.finished > self.retention_seconds:
+                del self._jobs[job_id]
+                if self._by_key.get(job.dedup_key) == job_id:
+                    del self._by_key[job.dedup_key]
@@ -0,0 +1,301 @@
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Process-wide instrumentation: wall time per review stage, AWS API calls,
+# retries and throttles per operation, and Bedrock token usage. Everything
+# goes to one registry that can be rendered in the Prometheus text format;
+# a Trace additionally collects the numbers of a single review (one job or
+# one batch item) for the timing panel and the batch output.
+
+throttle_error_codes = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'ServiceQuotaExceededException'
+}
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    def set(self, name, value, help_text=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    def observe(self, name, value, help_text=None, **labels):
+        # Summary without quantiles: count, sum and max are enough to spot the slow stage
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0.0, 0.0])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+            if help_text:
+                self._help.setdefault(name, help_text)
+
+    def render_prometheus(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            summaries = sorted(self._summaries.items())
+            help_texts = dict(self._help)
+
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                if name in help_texts:
+                    lines.append(f"# HELP {name} {help_texts[name]}")
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            if name not in declared:
+                declared.add(name)
+                if name in help_texts:
+                    lines.append(f"# HELP {name} {help_texts[name]}")
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), (count, total, maximum) in summaries:
+            if name not in declared:
+                declared.add(name)
+                if name in help_texts:
+                    lines.append(f"# HELP {name} {help_texts[name]}")
+                lines.append(f"# TYPE {name} summary")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_max{format_labels(labels)} {maximum:.6f}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # Written atomically so a scraper or node_exporter's textfile collector never sees half a file
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+registry = MetricsRegistry()
+
+
+class Trace:
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0})
+            stage['count'] += 1
+            stage['seconds'] += seconds
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def summary(self):
+        with self._lock:
+            return {
+                'stages': {name: {'count': stage['count'], 'seconds': round(stage['seconds'], 3)}
+                           for name, stage in self.stages.items()},
+                'counters': dict(self.counters)
+            }
+
+
+@contextmanager
+def use_trace(trace):
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+
+
+def in_context(function):
+    # For executor.submit(in_context(fn), ...): the worker thread sees the submitter's trace
+    return functools.partial(contextvars.copy_context().run, function)
+
+
+_log_lock = threading.Lock()
+
+
+def log_event(event, **fields):
+    # One JSON object per line so the logs can be filtered and aggregated. Shards and
+    # snapshot workers log at the same time; print() writes the text and the newline
+    # separately, so each line is written whole under a lock instead
+    line = json.dumps({'event': event, 'time': round(time.time(), 3), **fields}, default=str) + '\n'
+    with _log_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def trace_count(name, amount=1):
+    # Per-review counter; the registry keeps the labelled process-wide totals
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, amount)
+
+
+@contextmanager
+def stage(name, **fields):
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        registry.observe('wa_stage_seconds', seconds, help_text='Wall time of review stages', stage=name, status=status)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_stage(name, seconds)
+        log_event('stage', stage=name, status=status, seconds=round(seconds, 3), **fields)
+
+
+def timed(name):
+    # Decorator form of stage() for functions that are a stage on their own
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_bedrock_usage(model_id, input_tokens, output_tokens, cache_read_tokens=0):
+    if input_tokens:
+        trace_count('bedrock_input_tokens', input_tokens)
+        registry.inc('wa_bedrock_tokens_total', input_tokens, help_text='Bedrock tokens by direction',
+                     model=model_id, direction='input')
+    if output_tokens:
+        trace_count('bedrock_output_tokens', output_tokens)
+        registry.inc('wa_bedrock_tokens_total', output_tokens, help_text='Bedrock tokens by direction',
+                     model=model_id, direction='output')
+    if cache_read_tokens:
+        # Prompt prefix tokens served from Bedrock's prompt cache
+        trace_count('bedrock_cache_read_tokens', cache_read_tokens)
+        registry.inc('wa_bedrock_tokens_total', cache_read_tokens, help_text='Bedrock tokens by direction',
+                     model=model_id, direction='cache_read')
+
+
+def _event_operation(event_name):
+    # "after-call.bedrock-runtime.InvokeModel" -> ("bedrock-runtime", "InvokeModel")
+    parts = event_name.split('.')
+    return parts[1], parts[2]
+
+
+def _after_call(event_name, http_response=None, parsed=None, **kwargs):
+    service, operation = _event_operation(event_name)
+    parsed = parsed or {}
+    status = parsed.get('Error', {}).get('Code') or 'ok'
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    registry.inc('wa_aws_calls_total', help_text='AWS API calls by operation and outcome',
+                 service=service, operation=operation, status=status)
+    trace_count('aws_calls')
+    if retries:
+        registry.inc('wa_aws_retries_total', retries, help_text='Retried AWS API attempts',
+                     service=service, operation=operation)
+        trace_count('aws_retries', retries)
+
+
+def _after_call_error(event_name, exception=None, **kwargs):
+    service, operation = _event_operation(event_name)
+    registry.inc('wa_aws_calls_total', help_text='AWS API calls by operation and outcome',
+                 service=service, operation=operation, status=type(exception).__name__)
+    trace_count('aws_calls')
+
+
+def _needs_retry(event_name, response=None, **kwargs):
+    # Only observes; returning None leaves the retry decision to botocore
+    if not response:
+        return None
+    error_code = (response[1] or {}).get('Error', {}).get('Code')
+    if error_code in throttle_error_codes:
+        service, operation = _event_operation(event_name)
+        registry.inc('wa_aws_throttles_total', help_text='Throttled AWS API attempts',
+                     service=service, operation=operation)
+        trace_count('aws_throttles')
+    return None
+
+
+def instrument_client(client):
+    events = client.meta.events
+    events.register('after-call.*.*', _after_call, unique_id='wa-metrics-after-call')
+    events.register('after-call-error.*.*', _after_call_error, unique_id='wa-metrics-after-call-error')
+    events.register('needs-retry.*.*', _needs_retry, unique_id='wa-metrics-needs-retry')
+    return client
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    # Serves /metrics in a daemon thread; one server per process
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, name='wa-metrics', daemon=True).start()
+            print(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+        return _server
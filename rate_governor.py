@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from metrics import current_trace, registry, trace_count
+
+# Process-wide client-side rate limits for the Well-Architected Tool API. Every
+# request attempt of every WA client in the process (all sessions, jobs and
+# worker threads, including botocore's own retries) takes a token from the
+# bucket of its operation first. Callers that find the bucket empty wait in
+# line, and the line is served round-robin between reviews, so one large update
+# cannot starve the review of another session. The wait is the backpressure:
+# calls slow down to the quota instead of coming back as ThrottlingException.
+
+# (requests per second, burst) per operation. The WA Tool's quotas are per account
+# and region; these are kept below them, and wa_rate_limits overrides them.
+DEFAULT_RATE_LIMITS = {
+    'GetLensReview': (5, 5),
+    'ListAnswers': (10, 10),
+    'GetAnswer': (10, 10),
+    'UpdateAnswer': (5, 5),
+    'CreateMilestone': (1, 2),
+    'GetLensReviewReport': (1, 2)
+}
+DEFAULT_RATE_LIMIT = (5, 5)
+
+
+class OperationLimiter:
+    # Token bucket with a fair waiting line: one queue of callers per owner (review),
+    # and the owners take turns for the next token
+    def __init__(self, operation, rate, burst):
+        self.operation = operation
+        self.rate = float(rate)
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting = 0
+        self._queues = {}
+        self._turns = deque()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, owner):
+        # Blocks until this caller's turn has a token; returns the seconds waited
+        ticket = object()
+        with self._condition:
+            queue = self._queues.get(owner)
+            if queue is None:
+                queue = self._queues[owner] = deque()
+                self._turns.append(owner)
+            queue.append(ticket)
+            self.waiting += 1
+            self._report_depth()
+
+            started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                first_in_line = self._turns[0] == owner and queue[0] is ticket
+                if first_in_line and self.tokens >= 1:
+                    break
+                # Only the first in line sleeps until the next token; the others wait for their turn
+                self._condition.wait((1 - self.tokens) / self.rate if first_in_line else None)
+
+            self.tokens -= 1
+            queue.popleft()
+            self._turns.popleft()
+            if queue:
+                self._turns.append(owner)
+            else:
+                del self._queues[owner]
+            self.waiting -= 1
+            self._report_depth()
+            self._condition.notify_all()
+        return now - started
+
+    def _report_depth(self):
+        registry.set('wa_governor_queue_depth', self.waiting, help_text='Calls waiting for a WA API rate limit token',
+                     operation=self.operation)
+
+
+def parse_rate_limit(operation, limit):
+    # A number is requests per second with the same burst (at least 1); a pair is (rate, burst).
+    # A rate of 0 would never refill the bucket, so it is refused here rather than in every call.
+    if isinstance(limit, (list, tuple)) and len(limit) == 2:
+        rate, burst = limit
+    else:
+        rate, burst = limit, None
+    if not isinstance(rate, (int, float)) or rate <= 0:
+        raise ValueError(f"wa_rate_limits: the rate of {operation} must be a number above 0, got {limit!r}")
+    if burst is None:
+        burst = max(rate, 1)
+    if not isinstance(burst, (int, float)) or burst < 1:
+        raise ValueError(f"wa_rate_limits: the burst of {operation} must be a number of at least 1, got {limit!r}")
+    return rate, burst
+
+
+class RateGovernor:
+    def __init__(self, rate_limits=None, default_limit=DEFAULT_RATE_LIMIT):
+        self.default_limit = default_limit
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS)
+        for operation, limit in (rate_limits or {}).items():
+            self.rate_limits[operation] = parse_rate_limit(operation, limit)
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, operation):
+        with self._lock:
+            limiter = self._limiters.get(operation)
+            if limiter is None:
+                rate, burst = self.rate_limits.get(operation, self.default_limit)
+                limiter = self._limiters[operation] = OperationLimiter(operation, rate, burst)
+            return limiter
+
+    def acquire(self, operation):
+        # The fairness key is the review: a job's or batch item's trace, else the calling thread
+        trace = current_trace.get()
+        owner = id(trace) if trace is not None else threading.get_ident()
+        waited = self.limiter(operation).acquire(owner)
+        registry.observe('wa_governor_wait_seconds', waited, help_text='Time WA API calls waited for a rate limit token',
+                         operation=operation)
+        if waited >= 0.001:
+            trace_count('wa_governor_wait_ms', int(waited * 1000))
+        return waited
+
+    def _before_send(self, event_name, **kwargs):
+        # "before-send.wellarchitected.UpdateAnswer"; returning None lets botocore send the request
+        self.acquire(event_name.split('.')[2])
+        return None
+
+    def instrument_client(self, client):
+        client.meta.events.register('before-send.wellarchitected.*', self._before_send, unique_id='wa-rate-governor')
+        return client
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_rate_governor(settings):
+    # One governor per process; the limits of the first caller's settings apply
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = RateGovernor(settings.get('wa_rate_limits'))
+        return _governor
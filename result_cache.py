@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+# On-disk, content-addressed store for Bedrock analysis results.
+# A result is keyed by the template content, the best practices catalog version
+# and the model id, so a byte-for-byte identical review never reaches Bedrock twice.
+
+DEFAULT_CACHE_DIR = os.path.join('.wa_cache', 'analysis')
+# Last analyzed version of each template, for incremental re-analysis (same store, other directory)
+DEFAULT_HISTORY_DIR = os.path.join('.wa_cache', 'history')
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024  # 50 MB
+DEFAULT_MAX_AGE_SECONDS = 7 * 24 * 60 * 60  # one week
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_cache_key(template_body, catalog_body, model_id, variant=''):
+    # Each component is hashed on its own so the key is stable and unambiguous
+    parts = [content_hash(template_body), content_hash(catalog_body), model_id, str(variant)]
+    return hashlib.sha256('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+class AnalysisCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES,
+                 max_age_seconds=DEFAULT_MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age > self.max_age_seconds:
+                os.remove(path)
+                self._count('evictions')
+                self._count('misses')
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self._count('misses')
+            return None
+
+        # Touch the entry so eviction drops the least recently used results first
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._count('hits')
+        return entry.get('result')
+
+    def put(self, key, result, metadata=None):
+        entry = {
+            'key': key,
+            'created': time.time(),
+            'metadata': metadata or {},
+            'result': result
+        }
+        path = self._path(key)
+        # Write to a temporary file first so concurrent readers never see a partial entry
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing analysis cache entry {key}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._count('writes')
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age_seconds:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        # Drop the least recently used entries until the store fits its size budget
+        total_size = sum(size for _, size, _ in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            self._count('evictions')
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,526 @@
+from collections import namedtuple
+from catalog import practice_id_from_name
+
+# Deterministic checks that settle best practices straight from the template.
+# Each rule is registered for the resource types it needs; only rules whose
+# types appear in the template are evaluated. A rule returns (True, reason) when
+# the practice is applied, (False, reason) when the template shows it is not,
+# or None when the template alone cannot tell (the practice then goes to Bedrock).
+
+# Bump when rules change so cached analyses produced by older rules are not reused
+rules_version = 1
+
+Rule = namedtuple('Rule', ['practice_id', 'resource_types', 'check'])
+RuleResults = namedtuple('RuleResults', ['applied', 'settled'])
+
+registered_rules = []
+rules_by_type = {}
+
+
+def rule(practice_id, *resource_types):
+    # Use '*' for rules that look at the whole template rather than a resource type
+    def register(check):
+        new_rule = Rule(practice_id, resource_types, check)
+        registered_rules.append(new_rule)
+        for resource_type in resource_types:
+            rules_by_type.setdefault(resource_type, []).append(new_rule)
+        return check
+    return register
+
+
+class RuleContext:
+    def __init__(self, template):
+        self.template = template
+        self.parameters = template.get('Parameters') or {}
+        self.resources_by_type = {}
+        for logical_id, resource in (template.get('Resources') or {}).items():
+            if isinstance(resource, dict):
+                self.resources_by_type.setdefault(resource.get('Type'), []).append((logical_id, resource))
+
+    def resources(self, *resource_types):
+        found = []
+        for resource_type in resource_types:
+            found.extend(self.resources_by_type.get(resource_type, []))
+        return found
+
+    def resolve(self, value):
+        # Literal values and parameter defaults are known; anything else is not
+        if isinstance(value, dict):
+            if list(value) == ['Ref']:
+                parameter = self.parameters.get(value['Ref'])
+                if isinstance(parameter, dict):
+                    return parameter.get('Default')
+            return None
+        return value
+
+    def as_bool(self, value):
+        value = self.resolve(value)
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        return None
+
+    def as_int(self, value):
+        try:
+            return int(self.resolve(value))
+        except (TypeError, ValueError):
+            return None
+
+
+def properties(resource):
+    return resource.get('Properties') or {}
+
+
+def contains_text(value, needle):
+    if isinstance(value, str):
+        return needle in value
+    if isinstance(value, dict):
+        return any(contains_text(item, needle) for item in value.values())
+    if isinstance(value, list):
+        return any(contains_text(item, needle) for item in value)
+    return False
+
+
+def has_key(value, key):
+    if isinstance(value, dict):
+        return key in value or any(has_key(item, key) for item in value.values())
+    if isinstance(value, list):
+        return any(has_key(item, key) for item in value)
+    return False
+
+
+def names(resources):
+    return ', '.join(logical_id for logical_id, _ in resources)
+
+
+def list_length(value):
+    return len(value) if isinstance(value, list) else 0
+
+
+##Reliability
+@rule('REL10-BP01', 'AWS::RDS::DBInstance', 'AWS::RDS::DBCluster', 'AWS::AutoScaling::AutoScalingGroup',
+      'AWS::ElasticLoadBalancingV2::LoadBalancer')
+def multi_location_deployment(context):
+    evidence = []
+    for logical_id, resource in context.resources('AWS::RDS::DBInstance'):
+        if context.as_bool(properties(resource).get('MultiAZ')):
+            evidence.append(f"{logical_id} is Multi-AZ")
+    for logical_id, resource in context.resources('AWS::RDS::DBCluster'):
+        if list_length(properties(resource).get('AvailabilityZones')) > 1:
+            evidence.append(f"{logical_id} spans multiple AZs")
+    for logical_id, resource in context.resources('AWS::AutoScaling::AutoScalingGroup'):
+        props = properties(resource)
+        if max(list_length(props.get('VPCZoneIdentifier')), list_length(props.get('AvailabilityZones'))) > 1:
+            evidence.append(f"{logical_id} spans multiple subnets")
+    for logical_id, resource in context.resources('AWS::ElasticLoadBalancingV2::LoadBalancer'):
+        props = properties(resource)
+        if max(list_length(props.get('Subnets')), list_length(props.get('SubnetMappings'))) > 1:
+            evidence.append(f"{logical_id} spans multiple subnets")
+    if evidence:
+        return True, '; '.join(evidence)
+    return None
+
+
+@rule('REL09-BP03', 'AWS::Backup::BackupPlan', 'AWS::RDS::DBInstance', 'AWS::RDS::DBCluster')
+def automatic_backups(context):
+    plans = context.resources('AWS::Backup::BackupPlan')
+    if plans:
+        return True, f"AWS Backup plan {names(plans)} schedules backups"
+    databases = context.resources('AWS::RDS::DBInstance', 'AWS::RDS::DBCluster')
+    retention = [(logical_id, context.as_int(properties(resource).get('BackupRetentionPeriod')))
+                 for logical_id, resource in databases]
+    if any(days for _, days in retention):
+        return True, ', '.join(f"{logical_id} keeps automated backups for {days} days" for logical_id, days in retention if days)
+    if retention and all(days == 0 for _, days in retention):
+        return False, f"automated backups are disabled on {names(databases)}"
+    return None
+
+
+@rule('REL09-BP01', 'AWS::Backup::BackupPlan')
+def backup_data(context):
+    plans = context.resources('AWS::Backup::BackupPlan')
+    return True, f"AWS Backup plan {names(plans)} backs up workload data"
+
+
+@rule('REL09-BP02', 'AWS::Backup::BackupVault', 'AWS::RDS::DBInstance', 'AWS::RDS::DBCluster')
+def encrypted_backups(context):
+    vaults = [(logical_id, resource) for logical_id, resource in context.resources('AWS::Backup::BackupVault')
+              if properties(resource).get('EncryptionKeyArn')]
+    if vaults:
+        return True, f"backup vault {names(vaults)} is encrypted with a KMS key"
+    databases = context.resources('AWS::RDS::DBInstance', 'AWS::RDS::DBCluster')
+    encrypted = [(logical_id, resource) for logical_id, resource in databases
+                 if context.as_bool(properties(resource).get('StorageEncrypted'))]
+    if databases and len(encrypted) == len(databases):
+        return True, f"{names(encrypted)} use encrypted storage, so their snapshots are encrypted"
+    return None
+
+
+@rule('REL07-BP01', 'AWS::AutoScaling::AutoScalingGroup', 'AWS::ApplicationAutoScaling::ScalableTarget')
+def automated_scaling(context):
+    scalers = context.resources('AWS::AutoScaling::AutoScalingGroup', 'AWS::ApplicationAutoScaling::ScalableTarget')
+    return True, f"{names(scalers)} obtain and scale resources automatically"
+
+
+@rule('REL11-BP03', 'AWS::AutoScaling::AutoScalingGroup')
+def automated_healing(context):
+    groups = [(logical_id, resource) for logical_id, resource in context.resources('AWS::AutoScaling::AutoScalingGroup')
+              if properties(resource).get('HealthCheckType') == 'ELB']
+    if groups:
+        return True, f"{names(groups)} replace instances failing load balancer health checks"
+    return None
+
+
+@rule('REL06-BP03', 'AWS::CloudWatch::Alarm')
+def alarm_notifications(context):
+    alarms = [(logical_id, resource) for logical_id, resource in context.resources('AWS::CloudWatch::Alarm')
+              if properties(resource).get('AlarmActions')]
+    if alarms:
+        return True, f"CloudWatch alarms {names(alarms)} send notifications"
+    return None
+
+
+@rule('REL01-BP04', 'AWS::CloudWatch::Alarm')
+def quota_monitoring(context):
+    alarms = [(logical_id, resource) for logical_id, resource in context.resources('AWS::CloudWatch::Alarm')
+              if properties(resource).get('Namespace') == 'AWS/Usage']
+    if alarms:
+        return True, f"{names(alarms)} alarm on service quota usage"
+    return None
+
+
+@rule('REL02-BP01', 'AWS::ElasticLoadBalancingV2::LoadBalancer', 'AWS::CloudFront::Distribution')
+def highly_available_endpoints(context):
+    distributions = context.resources('AWS::CloudFront::Distribution')
+    if distributions:
+        return True, f"{names(distributions)} serve the public endpoint from CloudFront"
+    balancers = [(logical_id, resource) for logical_id, resource in context.resources('AWS::ElasticLoadBalancingV2::LoadBalancer')
+                 if properties(resource).get('Scheme', 'internet-facing') == 'internet-facing'
+                 and max(list_length(properties(resource).get('Subnets')), list_length(properties(resource).get('SubnetMappings'))) > 1]
+    if balancers:
+        return True, f"public endpoint {names(balancers)} is a load balancer across multiple subnets"
+    return None
+
+
+##Security
+@rule('SEC08-BP02', 'AWS::RDS::DBInstance', 'AWS::RDS::DBCluster', 'AWS::EC2::Volume', 'AWS::EFS::FileSystem',
+      'AWS::DynamoDB::Table', 'AWS::S3::Bucket')
+def encryption_at_rest(context):
+    checks = []
+    for logical_id, resource in context.resources('AWS::RDS::DBInstance', 'AWS::RDS::DBCluster', 'AWS::EC2::Volume', 'AWS::EFS::FileSystem'):
+        key = 'Encrypted' if resource.get('Type') in ('AWS::EC2::Volume', 'AWS::EFS::FileSystem') else 'StorageEncrypted'
+        checks.append((logical_id, context.as_bool(properties(resource).get(key))))
+    for logical_id, resource in context.resources('AWS::DynamoDB::Table'):
+        sse = properties(resource).get('SSESpecification') or {}
+        checks.append((logical_id, context.as_bool(sse.get('SSEEnabled'))))
+    for logical_id, resource in context.resources('AWS::S3::Bucket'):
+        # S3 encrypts new objects by default; an explicit configuration is still the stronger signal
+        checks.append((logical_id, True if properties(resource).get('BucketEncryption') else None))
+
+    unencrypted = [logical_id for logical_id, encrypted in checks if encrypted is False]
+    if unencrypted:
+        return False, f"{', '.join(unencrypted)} store data without encryption at rest"
+    if checks and all(encrypted for _, encrypted in checks):
+        return True, f"{', '.join(logical_id for logical_id, _ in checks)} are encrypted at rest"
+    return None
+
+
+@rule('SEC08-BP01', 'AWS::KMS::Key', 'AWS::RDS::DBInstance', 'AWS::RDS::DBCluster')
+def key_management(context):
+    keys = context.resources('AWS::KMS::Key')
+    if keys:
+        return True, f"KMS key {names(keys)} is managed in the template"
+    databases = [(logical_id, resource) for logical_id, resource in context.resources('AWS::RDS::DBInstance', 'AWS::RDS::DBCluster')
+                 if properties(resource).get('KmsKeyId')]
+    if databases:
+        return True, f"{names(databases)} use customer managed KMS keys"
+    return None
+
+
+@rule('SEC09-BP02', 'AWS::ElasticLoadBalancingV2::Listener')
+def encryption_in_transit(context):
+    listeners = context.resources('AWS::ElasticLoadBalancingV2::Listener')
+    secure = [(logical_id, resource) for logical_id, resource in listeners
+              if properties(resource).get('Protocol') in ('HTTPS', 'TLS')]
+    if secure:
+        return True, f"listener {names(secure)} terminates HTTPS/TLS"
+    redirects = [logical_id for logical_id, resource in listeners
+                 if contains_text(properties(resource).get('DefaultActions'), 'redirect')]
+    if not redirects:
+        return False, f"listeners {names(listeners)} accept plain text traffic only"
+    return None
+
+
+@rule('SEC09-BP01', 'AWS::CertificateManager::Certificate', 'AWS::ElasticLoadBalancingV2::Listener')
+def certificate_management(context):
+    certificates = context.resources('AWS::CertificateManager::Certificate')
+    if certificates:
+        return True, f"ACM certificate {names(certificates)} is managed in the template"
+    listeners = [(logical_id, resource) for logical_id, resource in context.resources('AWS::ElasticLoadBalancingV2::Listener')
+                 if properties(resource).get('Certificates')]
+    if listeners:
+        return True, f"listener {names(listeners)} uses a managed certificate"
+    return None
+
+
+@rule('SEC02-BP03', '*')
+def secrets_storage(context):
+    template_resources = context.template.get('Resources')
+    if contains_text(template_resources, '{{resolve:secretsmanager:') or contains_text(template_resources, '{{resolve:ssm-secure:'):
+        return True, "credentials are resolved from Secrets Manager or SSM SecureString dynamic references"
+    if context.resources('AWS::SecretsManager::Secret'):
+        return True, f"secrets are stored in Secrets Manager ({names(context.resources('AWS::SecretsManager::Secret'))})"
+    for logical_id, resource in context.resources('AWS::RDS::DBInstance', 'AWS::RDS::DBCluster'):
+        password = properties(resource).get('MasterUserPassword')
+        if isinstance(password, str):
+            return False, f"{logical_id} has a plain text master password in the template"
+    return None
+
+
+@rule('SEC05-BP02', 'AWS::EC2::SecurityGroup', 'AWS::EC2::SecurityGroupIngress')
+def layered_traffic_control(context):
+    groups = []
+    for logical_id, resource in context.resources('AWS::EC2::SecurityGroup'):
+        ingress_rules = properties(resource).get('SecurityGroupIngress') or []
+        if any(isinstance(ingress, dict) and ingress.get('SourceSecurityGroupId') for ingress in ingress_rules):
+            groups.append(logical_id)
+    for logical_id, resource in context.resources('AWS::EC2::SecurityGroupIngress'):
+        if properties(resource).get('SourceSecurityGroupId'):
+            groups.append(logical_id)
+    if groups:
+        return True, f"{', '.join(groups)} only admit traffic from other security groups"
+    return None
+
+
+@rule('SEC05-BP01', 'AWS::RDS::DBInstance')
+def network_layers(context):
+    private = [(logical_id, resource) for logical_id, resource in context.resources('AWS::RDS::DBInstance')
+               if context.as_bool(properties(resource).get('PubliclyAccessible')) is False]
+    public = [(logical_id, resource) for logical_id, resource in context.resources('AWS::RDS::DBInstance')
+              if context.as_bool(properties(resource).get('PubliclyAccessible'))]
+    if public:
+        return False, f"database {names(public)} is publicly accessible"
+    if private:
+        return True, f"database {names(private)} is kept in a private network layer"
+    return None
+
+
+@rule('SEC06-BP03', 'AWS::EC2::SecurityGroup')
+def interactive_access(context):
+    open_ssh = []
+    for logical_id, resource in context.resources('AWS::EC2::SecurityGroup'):
+        for ingress in properties(resource).get('SecurityGroupIngress') or []:
+            if not isinstance(ingress, dict) or ingress.get('CidrIp') != '0.0.0.0/0':
+                continue
+            from_port = context.as_int(ingress.get('FromPort'))
+            to_port = context.as_int(ingress.get('ToPort'))
+            if from_port is not None and to_port is not None and from_port <= 22 <= to_port:
+                open_ssh.append(logical_id)
+    if open_ssh:
+        return False, f"{', '.join(sorted(set(open_ssh)))} allow SSH from anywhere"
+    return None
+
+
+@rule('SEC04-BP01', 'AWS::CloudTrail::Trail', 'AWS::EC2::FlowLog', 'AWS::ElasticLoadBalancingV2::LoadBalancer', 'AWS::S3::Bucket')
+def service_logging(context):
+    sources = [logical_id for logical_id, _ in context.resources('AWS::CloudTrail::Trail', 'AWS::EC2::FlowLog')]
+    for logical_id, resource in context.resources('AWS::ElasticLoadBalancingV2::LoadBalancer'):
+        for attribute in properties(resource).get('LoadBalancerAttributes') or []:
+            if isinstance(attribute, dict) and attribute.get('Key') == 'access_logs.s3.enabled' and str(attribute.get('Value')).lower() == 'true':
+                sources.append(logical_id)
+    for logical_id, resource in context.resources('AWS::S3::Bucket'):
+        if properties(resource).get('LoggingConfiguration'):
+            sources.append(logical_id)
+    if sources:
+        return True, f"logging is configured on {', '.join(sources)}"
+    return None
+
+
+##Performance Efficiency
+@rule('PERF04-BP04', 'AWS::ElasticLoadBalancingV2::LoadBalancer', 'AWS::ElasticLoadBalancing::LoadBalancer')
+def load_balancing(context):
+    balancers = context.resources('AWS::ElasticLoadBalancingV2::LoadBalancer', 'AWS::ElasticLoadBalancing::LoadBalancer')
+    return True, f"{names(balancers)} distribute traffic across targets"
+
+
+@rule('PERF02-BP05', 'AWS::AutoScaling::AutoScalingGroup')
+def dynamic_compute_scaling(context):
+    groups = [(logical_id, resource) for logical_id, resource in context.resources('AWS::AutoScaling::AutoScalingGroup')
+              if (context.as_int(properties(resource).get('MaxSize')) or 0) > (context.as_int(properties(resource).get('MinSize')) or 0)]
+    if groups:
+        return True, f"{names(groups)} scale between their minimum and maximum size"
+    return None
+
+
+@rule('PERF02-BP03', 'AWS::AutoScaling::AutoScalingGroup', 'AWS::CloudWatch::Alarm')
+def compute_metrics(context):
+    sources = [logical_id for logical_id, resource in context.resources('AWS::AutoScaling::AutoScalingGroup')
+               if properties(resource).get('MetricsCollection')]
+    sources += [logical_id for logical_id, resource in context.resources('AWS::CloudWatch::Alarm')
+                if properties(resource).get('Namespace') in ('AWS/EC2', 'AWS/ECS', 'AWS/Lambda')]
+    if sources:
+        return True, f"compute metrics are collected by {', '.join(sources)}"
+    return None
+
+
+@rule('PERF03-BP03', 'AWS::RDS::DBInstance')
+def data_store_metrics(context):
+    databases = [(logical_id, resource) for logical_id, resource in context.resources('AWS::RDS::DBInstance')
+                 if context.as_bool(properties(resource).get('EnablePerformanceInsights'))
+                 or (context.as_int(properties(resource).get('MonitoringInterval')) or 0) > 0]
+    if databases:
+        return True, f"{names(databases)} record Performance Insights or Enhanced Monitoring metrics"
+    return None
+
+
+@rule('PERF03-BP05', 'AWS::ElastiCache::CacheCluster', 'AWS::ElastiCache::ReplicationGroup', 'AWS::DAX::Cluster',
+      'AWS::CloudFront::Distribution')
+def caching(context):
+    caches = context.resources('AWS::ElastiCache::CacheCluster', 'AWS::ElastiCache::ReplicationGroup', 'AWS::DAX::Cluster',
+                               'AWS::CloudFront::Distribution')
+    return True, f"{names(caches)} cache data access"
+
+
+##Operational Excellence
+@rule('OPS08-BP04', 'AWS::CloudWatch::Alarm')
+def actionable_alerts(context):
+    alarms = [(logical_id, resource) for logical_id, resource in context.resources('AWS::CloudWatch::Alarm')
+              if properties(resource).get('AlarmActions')]
+    if alarms:
+        return True, f"{names(alarms)} trigger actions when their threshold is breached"
+    return None
+
+
+@rule('OPS06-BP03', 'AWS::AutoScaling::AutoScalingGroup')
+def safe_deployments(context):
+    groups = [(logical_id, resource) for logical_id, resource in context.resources('AWS::AutoScaling::AutoScalingGroup')
+              if (resource.get('UpdatePolicy') or {}).get('AutoScalingRollingUpdate')]
+    if groups:
+        return True, f"{names(groups)} roll out changes with a rolling update policy"
+    return None
+
+
+@rule('OPS05-BP03', '*')
+def configuration_management(context):
+    managed = [logical_id for logical_id, resource in (context.template.get('Resources') or {}).items()
+               if isinstance(resource, dict) and 'AWS::CloudFormation::Init' in (resource.get('Metadata') or {})]
+    managed += [logical_id for logical_id, _ in context.resources('AWS::SSM::Association')]
+    if managed:
+        return True, f"instance configuration is managed by {', '.join(managed)}"
+    return None
+
+
+##Cost Optimization
+@rule('COST01-BP03', 'AWS::Budgets::Budget')
+def cloud_budgets(context):
+    return True, f"budget {names(context.resources('AWS::Budgets::Budget'))} is defined"
+
+
+@rule('COST01-BP06', 'AWS::CloudWatch::Alarm', 'AWS::Budgets::Budget', 'AWS::CE::AnomalyMonitor')
+def proactive_cost_monitoring(context):
+    monitors = [(logical_id, resource) for logical_id, resource in context.resources('AWS::CloudWatch::Alarm')
+                if properties(resource).get('Namespace') == 'AWS/Billing']
+    monitors += context.resources('AWS::Budgets::Budget', 'AWS::CE::AnomalyMonitor')
+    if monitors:
+        return True, f"{names(monitors)} watch spend proactively"
+    return None
+
+
+@rule('COST03-BP05', 'AWS::Budgets::Budget', 'AWS::CUR::ReportDefinition', 'AWS::CE::AnomalyMonitor')
+def billing_tools(context):
+    tools = context.resources('AWS::Budgets::Budget', 'AWS::CUR::ReportDefinition', 'AWS::CE::AnomalyMonitor')
+    return True, f"billing and cost management tools are configured ({names(tools)})"
+
+
+@rule('COST09-BP03', 'AWS::AutoScaling::AutoScalingGroup', 'AWS::ApplicationAutoScaling::ScalableTarget')
+def dynamic_supply(context):
+    scalers = context.resources('AWS::AutoScaling::AutoScalingGroup', 'AWS::ApplicationAutoScaling::ScalableTarget')
+    return True, f"{names(scalers)} supply capacity dynamically"
+
+
+@rule('COST04-BP05', 'AWS::S3::Bucket', 'AWS::Backup::BackupPlan')
+def data_retention(context):
+    policies = [logical_id for logical_id, resource in context.resources('AWS::S3::Bucket')
+                if properties(resource).get('LifecycleConfiguration')]
+    policies += [logical_id for logical_id, resource in context.resources('AWS::Backup::BackupPlan')
+                 if has_key(properties(resource), 'DeleteAfterDays')]
+    if policies:
+        return True, f"retention is enforced by lifecycle rules on {', '.join(policies)}"
+    return None
+
+
+##Sustainability
+@rule('SUS02-BP01', 'AWS::AutoScaling::AutoScalingGroup', 'AWS::ApplicationAutoScaling::ScalableTarget')
+def dynamic_infrastructure(context):
+    scalers = context.resources('AWS::AutoScaling::AutoScalingGroup', 'AWS::ApplicationAutoScaling::ScalableTarget')
+    return True, f"{names(scalers)} scale infrastructure with demand"
+
+
+@rule('SUS04-BP03', 'AWS::S3::Bucket', 'AWS::Backup::BackupPlan')
+def dataset_lifecycle(context):
+    result = data_retention(context)
+    if result:
+        return True, result[1]
+    return None
+
+
+@rule('SUS05-BP03', 'AWS::RDS::DBInstance', 'AWS::RDS::DBCluster', 'AWS::DynamoDB::Table', 'AWS::Lambda::Function',
+      'AWS::ECS::Service', 'AWS::ElastiCache::ReplicationGroup')
+def managed_services(context):
+    services = context.resources('AWS::RDS::DBInstance', 'AWS::RDS::DBCluster', 'AWS::DynamoDB::Table', 'AWS::Lambda::Function',
+                                 'AWS::ECS::Service', 'AWS::ElastiCache::ReplicationGroup')
+    return True, f"{names(services)} run on managed services"
+
+
+def collect_rule_outcomes(template, outcomes=None):
+    # Nested stacks are evaluated one template at a time into the same outcomes;
+    # a practice applied in any stack counts as applied
+    if outcomes is None:
+        outcomes = {}
+    context = RuleContext(template)
+
+    # Only rules registered for resource types present in the template are candidates
+    candidate_rules = list(rules_by_type.get('*', []))
+    for resource_type in context.resources_by_type:
+        for candidate in rules_by_type.get(resource_type, []):
+            if candidate not in candidate_rules:
+                candidate_rules.append(candidate)
+
+    for candidate in candidate_rules:
+        try:
+            outcome = candidate.check(context)
+        except Exception as e:
+            print(f"Rule for {candidate.practice_id} failed, leaving it to the model: {e}")
+            outcome = None
+        outcomes.setdefault(candidate.practice_id, []).append(outcome)
+    return outcomes
+
+
+def settle_rule_outcomes(outcomes, best_practices):
+    applied = {}
+    settled = set()
+    for entry in best_practices:
+        for practice in entry.get('Best Practice', []):
+            results = [outcome for outcome in outcomes.get(practice_id_from_name(practice), []) if outcome]
+            if any(is_applied for is_applied, _ in results):
+                applied[practice] = '; '.join(reason for is_applied, reason in results if is_applied)
+                settled.add(practice)
+            elif results:
+                settled.add(practice)
+    return RuleResults(applied, settled)
+
+
+def format_rule_results(rule_results):
+    # Same "[BP name]: reason" format the model answers with
+    return "\n".join(f"[{practice}]: Rule check: {reason}" for practice, reason in rule_results.applied.items())
+
+
+def remaining_best_practices(best_practices, settled):
+    # Catalog entries with the settled practices removed, empty questions dropped
+    remaining = []
+    for entry in best_practices:
+        practices = [practice for practice in entry.get('Best Practice', []) if practice not in settled]
+        if practices:
+            remaining.append(dict(entry, **{'Best Practice': practices}))
+    return remaining
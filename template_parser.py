@@ -0,0 +1,346 @@
+import json
+import os
+import re
+import threading
+from urllib.parse import unquote
+
+# Parse CloudFormation templates (JSON or YAML, including short-form intrinsics)
+# and reduce them to a compact resource inventory for the analysis prompt.
+# Nested stacks (AWS::CloudFormation::Stack) are followed into their child
+# templates, and inventories larger than the token budget are split into
+# chunks that are analyzed independently.
+
+# Short-form YAML tags and the long-form intrinsic they stand for
+intrinsic_tags = {
+    '!Ref': 'Ref',
+    '!Condition': 'Condition',
+    '!GetAtt': 'Fn::GetAtt',
+    '!Base64': 'Fn::Base64',
+    '!Cidr': 'Fn::Cidr',
+    '!FindInMap': 'Fn::FindInMap',
+    '!GetAZs': 'Fn::GetAZs',
+    '!ImportValue': 'Fn::ImportValue',
+    '!Join': 'Fn::Join',
+    '!Select': 'Fn::Select',
+    '!Split': 'Fn::Split',
+    '!Sub': 'Fn::Sub',
+    '!Transform': 'Fn::Transform',
+    '!And': 'Fn::And',
+    '!Equals': 'Fn::Equals',
+    '!If': 'Fn::If',
+    '!Not': 'Fn::Not',
+    '!Or': 'Fn::Or',
+    '!Length': 'Fn::Length',
+    '!ToJsonString': 'Fn::ToJsonString'
+}
+
+# Keys that cost tokens without saying anything about architecture
+boilerplate_keys = {
+    'Tags',
+    'Description',
+    'UserData',
+    'Metadata',
+    'ConstraintDescription',
+    'AllowedPattern',
+    'AllowedValues',
+    'MinLength',
+    'MaxLength',
+    'MinValue',
+    'MaxValue',
+    'Label',
+    'NoEcho'
+}
+
+# Resource-level attributes that matter for resilience and deployment practices
+resource_attributes = ['DependsOn', 'Condition', 'DeletionPolicy', 'UpdateReplacePolicy', 'UpdatePolicy', 'CreationPolicy']
+
+DEFAULT_TEMPLATE_TOKEN_BUDGET = 3000
+DEFAULT_MAX_TEMPLATE_CHUNKS = 8
+DEFAULT_NESTED_STACK_DEPTH = 3
+MAX_VALUE_LENGTH = 80
+MAX_DEPTH = 4
+
+NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+
+# TemplateURL forms: s3://bucket/key, virtual-hosted and path-style S3 HTTPS URLs
+s3_url_patterns = [
+    re.compile(r'^s3://(?P<bucket>[^/]+)/(?P<key>.+)$'),
+    re.compile(r'^https?://(?P<bucket>[^/]+)\.s3[.-](?:[a-z0-9-]+\.)?amazonaws\.com(?:\.cn)?/(?P<key>[^?]+)'),
+    re.compile(r'^https?://s3[.-](?:[a-z0-9-]+\.)?amazonaws\.com(?:\.cn)?/(?P<bucket>[^/]+)/(?P<key>[^?]+)')
+]
+
+
+class TemplateParseError(ValueError):
+    pass
+
+
+_yaml_loader = None
+_yaml_loader_lock = threading.Lock()
+
+
+def cfn_yaml_loader():
+    # Built on first use: most templates are JSON, so PyYAML stays off the app's startup path
+    global _yaml_loader
+    with _yaml_loader_lock:
+        if _yaml_loader is None:
+            import yaml
+
+            # libyaml's parser is several times faster on multi-MB templates; the constructors stay the same
+            class CfnYamlLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+                pass
+
+            CfnYamlLoader.add_multi_constructor('!', construct_intrinsic)
+            _yaml_loader = CfnYamlLoader
+        return _yaml_loader
+
+
+def construct_intrinsic(loader, tag_suffix, node):
+    tag = '!' + tag_suffix
+    function_name = intrinsic_tags.get(tag, 'Fn::' + tag_suffix)
+    if node.id == 'scalar':
+        value = loader.construct_scalar(node)
+        # !GetAtt Resource.Attribute is the only short form with a dotted scalar
+        if function_name == 'Fn::GetAtt':
+            value = value.split('.', 1)
+    elif node.id == 'sequence':
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    return {function_name: value}
+
+
+def load_template(template_body):
+    if isinstance(template_body, bytes):
+        template_body = template_body.decode('utf-8-sig')
+
+    try:
+        template = json.loads(template_body)
+    except ValueError:
+        import yaml
+        try:
+            template = yaml.load(template_body, Loader=cfn_yaml_loader())
+        except yaml.YAMLError as e:
+            raise TemplateParseError(f"Template is neither valid JSON nor YAML: {e}")
+
+    if not isinstance(template, dict) or not isinstance(template.get('Resources'), dict):
+        raise TemplateParseError("Template has no Resources section")
+    return template
+
+
+def estimate_tokens(text):
+    # Rough estimate for Claude models: about four characters per token
+    return len(text) // 4 + 1
+
+
+def shorten(text):
+    text = ' '.join(str(text).split())
+    if len(text) > MAX_VALUE_LENGTH:
+        return text[:MAX_VALUE_LENGTH - 3] + '...'
+    return text
+
+
+def find_references(value, found=None):
+    # Collect logical ids referenced through Ref, GetAtt and ${} substitutions
+    if found is None:
+        found = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'Ref' and isinstance(item, str):
+                found.add(item)
+            elif key == 'Fn::GetAtt':
+                if isinstance(item, list) and item:
+                    found.add(str(item[0]))
+                elif isinstance(item, str):
+                    found.add(item.split('.', 1)[0])
+            elif key == 'Fn::Sub':
+                sub_text = item[0] if isinstance(item, list) and item else item
+                if isinstance(sub_text, str):
+                    for name in re.findall(r'\$\{([^}!.]+)[^}]*\}', sub_text):
+                        found.add(name)
+                find_references(item, found)
+            else:
+                find_references(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            find_references(item, found)
+    return found
+
+
+def render_value(value, parameters, depth=0):
+    if isinstance(value, dict):
+        if len(value) == 1:
+            key, item = next(iter(value.items()))
+            if key == 'Ref':
+                default = parameters.get(item, {}).get('Default') if isinstance(parameters.get(item), dict) else None
+                if default is not None:
+                    return f"!Ref {item}[={shorten(default)}]"
+                return f"!Ref {item}"
+            if key == 'Fn::GetAtt':
+                target = '.'.join(str(part) for part in item) if isinstance(item, list) else item
+                return f"!GetAtt {target}"
+            if key == 'Fn::Sub' and isinstance(item, str):
+                return f"!Sub {shorten(item)}"
+            if key.startswith('Fn::'):
+                return f"!{key[4:]} {render_value(item, parameters, depth + 1)}"
+        if depth >= MAX_DEPTH:
+            return '{...}'
+        parts = [
+            f"{key}: {render_value(item, parameters, depth + 1)}"
+            for key, item in value.items() if key not in boilerplate_keys
+        ]
+        return '{' + ', '.join(parts) + '}'
+    if isinstance(value, list):
+        if depth >= MAX_DEPTH:
+            return '[...]'
+        return '[' + ', '.join(render_value(item, parameters, depth + 1) for item in value) + ']'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return shorten(value)
+
+
+def summarize_resource(logical_id, resource, parameters, resource_ids, prefix=''):
+    # prefix is the path of the nested stack, e.g. "Network/"
+    resource_type = resource.get('Type', 'Unknown')
+    lines = [f"- {prefix}{logical_id}: {resource_type}"]
+
+    properties = resource.get('Properties') or {}
+    rendered = [
+        f"{key}={render_value(value, parameters)}"
+        for key, value in properties.items() if key not in boilerplate_keys
+    ]
+    for attribute in resource_attributes:
+        if attribute in resource:
+            rendered.append(f"{attribute}={render_value(resource[attribute], parameters)}")
+    if rendered:
+        lines.append('  ' + '; '.join(rendered))
+
+    depends_on = resource.get('DependsOn', [])
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    references = (find_references(properties) | set(depends_on)) & resource_ids
+    references.discard(logical_id)
+    if references:
+        lines.append('  refs: ' + ', '.join(prefix + reference for reference in sorted(references)))
+    return '\n'.join(lines)
+
+
+def nested_stack_url(resource):
+    # Only literal TemplateURLs can be followed; !Sub and friends are left to the summary
+    if resource.get('Type') != NESTED_STACK_TYPE:
+        return None
+    template_url = (resource.get('Properties') or {}).get('TemplateURL')
+    return template_url if isinstance(template_url, str) else None
+
+
+def iter_stacks(template, fetch_template=None, max_depth=DEFAULT_NESTED_STACK_DEPTH, prefix='', depth=0):
+    # Yields (prefix, template) for the template and, depth first, every nested stack
+    # fetch_template can load. A child is only loaded when it is reached and dropped
+    # once its subtree is done, so at most one template per nesting level is in memory.
+    yield prefix, template
+    if fetch_template is None or depth >= max_depth:
+        return
+    for logical_id, resource in (template.get('Resources') or {}).items():
+        template_url = nested_stack_url(resource) if isinstance(resource, dict) else None
+        if not template_url:
+            continue
+        try:
+            child_template = load_template(fetch_template(template_url))
+        except Exception as e:
+            print(f"Could not load nested stack {prefix}{logical_id} from {template_url}: {e}")
+            continue
+        yield from iter_stacks(child_template, fetch_template, max_depth, f"{prefix}{logical_id}/", depth + 1)
+
+
+def chunk_stacks(stacks, token_budget=DEFAULT_TEMPLATE_TOKEN_BUDGET, max_chunks=DEFAULT_MAX_TEMPLATE_CHUNKS):
+    # Packs the resource summaries of (prefix, template) pairs into at most max_chunks
+    # inventories of about token_budget tokens each. Resources past the last chunk are
+    # only counted, so memory and prompt size stay bounded for any template size.
+    header = []
+    chunks = []
+    resource_lines = []
+    used_tokens = 0
+    resource_count = 0
+    nested_stacks = []
+    omitted_types = {}
+    for prefix, template in stacks:
+        parameters = template.get('Parameters') or {}
+        resources = template.get('Resources') or {}
+        resource_ids = set(resources)
+        if prefix:
+            nested_stacks.append(prefix.rstrip('/'))
+        elif template.get('Transform'):
+            header.append(f"Transform: {render_value(template['Transform'], parameters)}")
+            used_tokens = estimate_tokens(header[0])
+        for logical_id, resource in resources.items():
+            if not isinstance(resource, dict):
+                continue
+            resource_count += 1
+            resource_type = resource.get('Type', 'Unknown')
+            if omitted_types:
+                # Budget already spent: only keep a count of what was left out
+                omitted_types[resource_type] = omitted_types.get(resource_type, 0) + 1
+                continue
+            summary = summarize_resource(logical_id, resource, parameters, resource_ids, prefix)
+            summary_tokens = estimate_tokens(summary)
+            if resource_lines and used_tokens + summary_tokens > token_budget:
+                chunks.append(resource_lines)
+                resource_lines = []
+                used_tokens = 0
+                if len(chunks) >= max_chunks:
+                    omitted_types[resource_type] = 1
+                    continue
+            resource_lines.append(summary)
+            used_tokens += summary_tokens
+    if resource_lines or not chunks:
+        chunks.append(resource_lines)
+
+    if nested_stacks:
+        header.append(f"Nested stacks ({len(nested_stacks)}): {', '.join(nested_stacks)}")
+    formatted_chunks = []
+    for index, chunk_lines in enumerate(chunks, 1):
+        part = f", part {index} of {len(chunks)}" if len(chunks) > 1 else ''
+        formatted_chunks.append(header + [f"Resources ({resource_count}{part}):"] + chunk_lines)
+    if omitted_types:
+        omitted = ', '.join(f"{count}x {resource_type}" for resource_type, count in sorted(omitted_types.items()))
+        formatted_chunks[-1].append(f"(omitted to fit the token budget: {omitted})")
+    return ['\n'.join(lines) for lines in formatted_chunks]
+
+
+def s3_location(template_url):
+    for pattern in s3_url_patterns:
+        match = pattern.match(template_url)
+        if match:
+            return match.group('bucket'), unquote(match.group('key'))
+    return None
+
+
+def make_template_fetcher(s3_client=None, base_dir=None, allowed_buckets=None):
+    # fetch_template(url) for nested stacks: S3 URLs through s3_client (optionally only
+    # from allowed_buckets) and, with base_dir, relative paths of unpackaged templates.
+    # Local paths outside base_dir are refused so an uploaded template can't read server files.
+    def fetch_template(template_url):
+        location = s3_location(template_url)
+        if location:
+            bucket, key = location
+            if s3_client is None:
+                raise TemplateParseError("No S3 client to fetch nested templates")
+            if allowed_buckets is not None and bucket not in allowed_buckets:
+                raise TemplateParseError(f"Nested templates are not read from bucket {bucket}")
+            return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+        if base_dir is None or '://' in template_url:
+            raise TemplateParseError("Only S3 template URLs can be fetched")
+        root = os.path.realpath(base_dir)
+        path = os.path.realpath(os.path.join(root, template_url))
+        if os.path.commonpath([root, path]) != root:
+            raise TemplateParseError(f"{template_url} is outside {base_dir}")
+        with open(path, 'rb') as f:
+            return f.read()
+    return fetch_template
+
+
+def truncate_template_body(template_body, token_budget=DEFAULT_TEMPLATE_TOKEN_BUDGET):
+    # Fallback for templates that cannot be parsed: send the raw text, cut to the budget
+    if isinstance(template_body, bytes):
+        template_body = template_body.decode('utf-8', errors='replace')
+    return template_body[:token_budget * 4]
@@ -0,0 +1,840 @@
+import base64
+import json
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from botocore.exceptions import ClientError, ReadTimeoutError, EndpointConnectionError
+from catalog import find_practice_id, parse_analysis
+from result_cache import content_hash, make_cache_key
+from incremental import (
+    affected_questions,
+    carry_forward_findings,
+    diff_resources,
+    split_best_practices,
+    with_fingerprints
+)
+from template_parser import (
+    DEFAULT_MAX_TEMPLATE_CHUNKS,
+    DEFAULT_NESTED_STACK_DEPTH,
+    DEFAULT_TEMPLATE_TOKEN_BUDGET,
+    TemplateParseError,
+    chunk_stacks,
+    estimate_tokens,
+    iter_stacks,
+    load_template,
+    truncate_template_body
+)
+from wa_snapshot import DEFAULT_TTL_SECONDS, get_snapshot, invalidate_snapshot
+from wa_updates import apply_answer_updates, plan_answer_updates
+from rules import rules_version, collect_rule_outcomes, settle_rule_outcomes, format_rule_results, remaining_best_practices
+from metrics import in_context, log_event, record_bedrock_usage, registry, stage, timed, trace_count
+
+# The review pipeline without any Streamlit: analyze a template with Bedrock,
+# write the applied best practices to the WA Tool, create a milestone and
+# summarize risks. Used by the web app (settings = st.secrets) and by the
+# batch CLI (settings = a plain dict); settings only need a .get method.
+
+DEFAULT_MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+DEFAULT_LENS_ALIAS = 'wellarchitected'
+
+# Bump when the analysis prompt changes so cached results from older prompts are not reused
+analysis_prompt_version = 3
+
+# "compact": the model answers with best practice ids only and reasons are asked for
+# when the user wants them; "reasons": the model explains every practice it finds
+DEFAULT_OUTPUT_MODE = 'compact'
+
+# Reason recorded for practices found in compact mode until it is asked for
+PENDING_REASON = 'Reason available on request'
+
+# With triage_model_id set, a small model checks every practice first and only the
+# practices it is unsure about, plus its findings in these pillars, go to model_id
+DEFAULT_ESCALATE_PILLARS = ['Security', 'Reliability']
+DEFAULT_ESCALATION_BUDGET_SECONDS = 120
+DEFAULT_ESCALATION_MAX_PRACTICES = 80
+
+PromptOptions = namedtuple('PromptOptions', [
+    'output_mode',      # 'compact' or 'reasons'
+    'prompt_caching',   # mark the best practices prefix for Bedrock prompt caching
+    'mark_uncertain'    # ask the model to flag practices it cannot decide ("? [BP name]: reason")
+])
+default_prompt_options = PromptOptions('reasons', False, False)
+
+# A practice the triage model is unsure about, e.g. "? [REL09-BP02 Secure and encrypt backups]: reason"
+uncertain_line_pattern = re.compile(r'^\s*\?\s*\[([^\]\n]+)\]:?[ \t]*([^\n]*)$', re.MULTILINE)
+
+# Bedrock errors worth retrying for a single analysis shard
+retryable_bedrock_errors = {
+    'ThrottlingException',
+    'ServiceUnavailableException',
+    'ModelTimeoutException',
+    'ModelNotReadyException',
+    'ModelStreamErrorException',
+    'InternalServerException'
+}
+
+
+def pack_best_practices(best_practices, token_budget):
+    # Greedily pack whole questions into shards that stay under the token budget
+    shards = []
+    current_shard = []
+    current_tokens = 0
+    for entry in best_practices:
+        entry_tokens = estimate_tokens(json.dumps(entry, indent=2))
+        if current_shard and current_tokens + entry_tokens > token_budget:
+            shards.append(current_shard)
+            current_shard = []
+            current_tokens = 0
+        current_shard.append(entry)
+        current_tokens += entry_tokens
+    if current_shard:
+        shards.append(current_shard)
+    return shards
+
+
+def shard_best_practices(best_practices, shard_mode='pillar', token_budget=0):
+    if shard_mode == 'none':
+        return [best_practices]
+
+    if shard_mode == 'tokens':
+        return pack_best_practices(best_practices, token_budget or 2000)
+
+    # Default: one shard per pillar, optionally split further by the token budget
+    pillars = {}
+    for entry in best_practices:
+        pillars.setdefault(entry.get('Pillar', 'Unknown'), []).append(entry)
+
+    shards = []
+    for pillar_entries in pillars.values():
+        if token_budget:
+            shards.extend(pack_best_practices(pillar_entries, token_budget))
+        else:
+            shards.append(pillar_entries)
+    return shards
+
+
+def build_analysis_prompt(template_summary, best_practices, prompt_options=default_prompt_options):
+    # Content blocks: instructions and best practices first, the template last. The first
+    # block is the same for every template of a shard, so Bedrock can cache it.
+    best_practices_json = json.dumps(best_practices, indent=2)
+
+    if prompt_options.output_mode == 'compact':
+        answer_format = """
+    For each best practice, respond with its id only, one per line, in the following EXACT format:
+    REL09-BP02
+
+    IMPORTANT: Only the id, as given at the start of the best practice name. No names, reasons or other text.
+
+    List only the practices which are Applied
+    """
+    else:
+        answer_format = """
+    For each best practice, respond in the following EXACT format only: 
+    [Exact Best Practice Name as given in Best Practices]: [Why do you consider this best practice applicable?]
+
+    IMPORTANT: Use the EXACT best practice name as given in the Best Practices. 
+
+    Do not rephrase or summarize the practice name. List only the practices which are Applied
+    """
+    if prompt_options.mark_uncertain:
+        answer_format += """
+    If the template does not let you decide whether a best practice is applied, list it on a line
+    of its own starting with "? ", in the same format, e.g. "? REL09-BP02" or "? [REL09-BP02 ...]: reason"
+    """
+
+    prompt_prefix = f"""
+    For each of the following best practices from the AWS Well-Architected Framework, determine if it is applied in the CloudFormation template given at the end. 
+
+    Best Practices:
+    {best_practices_json}
+    {answer_format}"""
+
+    template_part = f"""
+    The CloudFormation template, given as a compact resource inventory
+    (one entry per resource with its type, key properties and the resources it references):
+    {template_summary}
+    """
+    #for debugging
+    #print(prompt_prefix + template_part)
+    prefix_block = {"type": "text", "text": prompt_prefix}
+    if prompt_options.prompt_caching:
+        prefix_block["cache_control"] = {"type": "ephemeral"}
+    return [prefix_block, {"type": "text", "text": template_part}]
+
+
+def build_explain_prompt(template_summary, practice_names):
+    practices_text = "\n".join(practice_names)
+    return f"""
+    Analyze the following CloudFormation template, given as a compact resource inventory
+    (one entry per resource with its type, key properties and the resources it references):
+    {template_summary}
+
+    The following best practices from the AWS Well-Architected Framework were found to be applied in it:
+    {practices_text}
+
+    For each best practice, respond in the following EXACT format only: 
+    [Exact Best Practice Name as given above]: [Why do you consider this best practice applicable?]
+
+    Keep each reason to one sentence that names the resources it is based on.
+    """
+
+
+def build_request_body(user_message):
+    # user_message is a string or a list of content blocks
+    if isinstance(user_message, str):
+        user_message = [{"type": "text", "text": user_message}]
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 4096,
+        "messages": [
+            {
+                "role": "user",
+                "content": user_message
+            }
+        ]
+    }
+
+
+def compact_answer_line(line, names_by_id):
+    # "REL09-BP02" -> "[REL09-BP02 Secure and encrypt backups]: <pending reason>"; ids outside the shard are dropped
+    name = names_by_id.get(find_practice_id(line) or '')
+    if name is None:
+        return None
+    if line.lstrip().startswith('?'):
+        return f"? [{name}]: {PENDING_REASON}"
+    return f"[{name}]: {PENDING_REASON}"
+
+
+def invoke_bedrock_analysis(bedrock_client, user_message, model_id):
+    response = bedrock_client.invoke_model(
+        modelId=model_id,
+        contentType='application/json',
+        accept='application/json',
+        body=json.dumps(build_request_body(user_message))
+    )
+    
+    response_body = json.loads(response['body'].read())
+    analysis_content = response_body.get('content', [])
+    usage = response_body.get('usage', {})
+    record_bedrock_usage(model_id, usage.get('input_tokens'), usage.get('output_tokens'), usage.get('cache_read_input_tokens', 0))
+    
+    return "\n".join(
+        item['text'] for item in analysis_content if item['type'] == 'text'
+    )
+
+
+def stream_bedrock_analysis(bedrock_client, user_message, model_id):
+    # Yield the generated text as it arrives instead of waiting for the whole reply
+    response = bedrock_client.invoke_model_with_response_stream(
+        modelId=model_id,
+        contentType='application/json',
+        accept='application/json',
+        body=json.dumps(build_request_body(user_message))
+    )
+    input_tokens = output_tokens = cache_read_tokens = 0
+    for event in response['body']:
+        chunk = event.get('chunk')
+        if not chunk:
+            continue
+        payload = json.loads(chunk['bytes'])
+        if payload.get('type') == 'content_block_delta' and payload.get('delta', {}).get('type') == 'text_delta':
+            yield payload['delta'].get('text', '')
+        elif payload.get('type') == 'message_start':
+            usage = payload.get('message', {}).get('usage', {})
+            input_tokens = usage.get('input_tokens', 0)
+            cache_read_tokens = usage.get('cache_read_input_tokens', 0)
+        elif payload.get('type') == 'message_delta':
+            output_tokens = payload.get('usage', {}).get('output_tokens', output_tokens)
+    record_bedrock_usage(model_id, input_tokens, output_tokens, cache_read_tokens)
+
+
+def iter_analysis_lines(text_chunks):
+    # Re-assemble streamed text fragments into complete lines
+    buffer = ''
+    for text in text_chunks:
+        buffer += text
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            yield line
+    if buffer:
+        yield buffer
+
+
+def is_retryable_bedrock_error(e):
+    if not isinstance(e, ClientError):
+        return True
+    # Errors raised inside a response stream use camelCase codes, e.g. throttlingException
+    error_code = e.response['Error']['Code']
+    return error_code[:1].upper() + error_code[1:] in retryable_bedrock_errors
+
+
+def analyze_shard(bedrock_client, template_summary, shard, model_id, max_attempts, line_queue=None,
+                  prompt_options=default_prompt_options):
+    # Each shard retries on its own so one throttled call doesn't redo the others
+    user_message = build_analysis_prompt(template_summary, shard, prompt_options)
+    # Compact answers are turned into "[BP name]: reason" lines right away, so the rest of the pipeline stays the same
+    names_by_id = None
+    if prompt_options.output_mode == 'compact':
+        names_by_id = {find_practice_id(name): name for entry in shard for name in entry['Best Practice']}
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with stage('bedrock_call', model_id=model_id, attempt=attempt):
+                if line_queue is None:
+                    text = invoke_bedrock_analysis(bedrock_client, user_message, model_id)
+                    if names_by_id is None:
+                        return text
+                    return "\n".join(filter(None, (compact_answer_line(line, names_by_id) for line in text.splitlines())))
+                lines = []
+                for line in iter_analysis_lines(stream_bedrock_analysis(bedrock_client, user_message, model_id)):
+                    if names_by_id is not None:
+                        line = compact_answer_line(line, names_by_id)
+                        if line is None:
+                            continue
+                    lines.append(line)
+                    line_queue.put(line)
+                return "\n".join(lines)
+        except (ClientError, ReadTimeoutError, EndpointConnectionError) as e:
+            if not is_retryable_bedrock_error(e):
+                raise
+            if attempt == max_attempts:
+                raise
+            delay = min(2 ** attempt, 20) + random.uniform(0, 1)
+            print(f"Retrying analysis shard after error (attempt {attempt}/{max_attempts}): {e}")
+            time.sleep(delay)
+
+
+def merge_analysis_results(partial_results):
+    # Combine shard answers into one "[BP name]: reason" list, first answer for a practice id wins.
+    # Practices flagged as uncertain ("? [BP name]: reason") are kept after the applied ones.
+    merged_lines = []
+    uncertain_lines = []
+    seen_practices = set()
+    for partial_result in partial_results:
+        for practice, reason in parse_analysis(partial_result):
+            practice_key = find_practice_id(practice) or practice
+            if practice_key in seen_practices:
+                continue
+            seen_practices.add(practice_key)
+            merged_lines.append(f"[{practice}]: {reason}")
+        for practice, reason in uncertain_line_pattern.findall(partial_result or ''):
+            practice_key = '?' + (find_practice_id(practice) or practice)
+            if practice_key in seen_practices:
+                continue
+            seen_practices.add(practice_key)
+            uncertain_lines.append(f"? [{practice}]: {reason}")
+    return "\n".join(merged_lines + uncertain_lines)
+
+
+def finished_shard_results(calls, futures, unfinished=None):
+    # Merged answers of the calls that finished; the shards of the others are added to unfinished
+    partial_results = []
+    for (template_summary, shard), future in zip(calls, futures):
+        if future.done() and not future.cancelled():
+            partial_results.append(future.result())
+        elif unfinished is not None:
+            unfinished.append(shard)
+    return merge_analysis_results(partial_results)
+
+
+def run_streaming_shards(bedrock_client, template_chunks, shards, model_id, max_workers, max_attempts, on_line,
+                         prompt_options=default_prompt_options, deadline=None, unfinished=None):
+    # Workers push lines onto a queue; the script thread drains it so Streamlit calls stay on it
+    line_queue = queue.Queue()
+    calls = [(template_summary, shard) for template_summary in template_chunks for shard in shards]
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(calls)))
+    try:
+        futures = [executor.submit(in_context(analyze_shard), bedrock_client, template_summary, shard, model_id, max_attempts, line_queue,
+                                   prompt_options) for template_summary, shard in calls]
+        while deadline is None or time.perf_counter() < deadline:
+            try:
+                on_line(line_queue.get(timeout=0.1))
+                continue
+            except queue.Empty:
+                pass
+            if not wait(futures, timeout=0).not_done and line_queue.empty():
+                break
+    finally:
+        # Calls still running at the deadline are left behind; their lines are no longer streamed
+        executor.shutdown(wait=deadline is None, cancel_futures=deadline is not None)
+    return finished_shard_results(calls, futures, unfinished)
+
+
+def run_analysis_shards(bedrock_client, template_chunks, shards, model_id, max_workers, max_attempts, on_line=None,
+                        prompt_options=default_prompt_options, deadline=None, unfinished=None):
+    # One call per template chunk and best practice shard, so each reply stays far below max_tokens.
+    # With a deadline (time.perf_counter()), calls not finished by then are dropped and their shards added to unfinished.
+    if on_line is not None:
+        return run_streaming_shards(bedrock_client, template_chunks, shards, model_id, max_workers, max_attempts, on_line,
+                                    prompt_options, deadline, unfinished)
+
+    calls = [(template_summary, shard) for template_summary in template_chunks for shard in shards]
+    if len(calls) == 1 and deadline is None:
+        return analyze_shard(bedrock_client, calls[0][0], calls[0][1], model_id, max_attempts, prompt_options=prompt_options)
+
+    # Bounded pool: wall-clock time grows with the number of calls per worker, not the template size
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(calls)))
+    try:
+        futures = [executor.submit(in_context(analyze_shard), bedrock_client, template_summary, shard, model_id, max_attempts, None,
+                                   prompt_options) for template_summary, shard in calls]
+        wait(futures, timeout=None if deadline is None else max(deadline - time.perf_counter(), 0))
+    finally:
+        executor.shutdown(wait=deadline is None, cancel_futures=deadline is not None)
+    return finished_shard_results(calls, futures, unfinished)
+
+
+def run_model(bedrock_client, template_chunks, best_practices, settings, model_id, on_line=None,
+              prompt_options=default_prompt_options, deadline=None, unfinished=None):
+    shards = shard_best_practices(
+        best_practices,
+        settings.get("analysis_shard_mode", "pillar"),
+        int(settings.get("analysis_shard_token_budget", 0))
+    )
+    print(f"Analyzing {len(template_chunks)} template chunks x {len(shards)} best practice shards with {model_id}")
+    return run_analysis_shards(
+        bedrock_client,
+        template_chunks,
+        shards,
+        model_id,
+        int(settings.get("analysis_max_workers", 6)),
+        int(settings.get("analysis_max_attempts", 3)),
+        on_line,
+        prompt_options,
+        deadline,
+        unfinished
+    )
+
+
+def run_tiered_analysis(bedrock_client, template_chunks, best_practices, settings, started, on_line=None,
+                        prompt_options=default_prompt_options):
+    # Triage with the small model, then escalate what it is unsure about and its findings in
+    # the escalated pillars to model_id, as far as the review's time and practice budget allows.
+    # Returns the analysis and whether the time budget let every candidate be escalated.
+    triage_model_id = settings["triage_model_id"]
+    model_id = settings.get("model_id", DEFAULT_MODEL_ID)
+    escalate_pillars = set(settings.get("escalate_pillars", DEFAULT_ESCALATE_PILLARS))
+    budget_seconds = float(settings.get("escalation_budget_seconds", DEFAULT_ESCALATION_BUDGET_SECONDS))
+    max_escalated = int(settings.get("escalation_max_practices", DEFAULT_ESCALATION_MAX_PRACTICES))
+
+    pillar_by_id = {}
+    for entry in best_practices:
+        for name in entry['Best Practice']:
+            pillar_by_id[find_practice_id(name) or name] = entry['Pillar']
+
+    # Findings that may still be escalated are only streamed once they are settled
+    def stream_settled(line):
+        if pillar_by_id.get(find_practice_id(line) or '') not in escalate_pillars:
+            on_line(line)
+    triage_on_line = stream_settled if on_line is not None else None
+
+    with stage('analysis_triage', model_id=triage_model_id):
+        triage_result = run_model(bedrock_client, template_chunks, best_practices, settings, triage_model_id,
+                                  triage_on_line, prompt_options._replace(mark_uncertain=True))
+    triage_found = {}
+    for practice, reason in parse_analysis(triage_result):
+        triage_found.setdefault(find_practice_id(practice) or practice, (practice, reason))
+    uncertain = []
+    for practice, reason in uncertain_line_pattern.findall(triage_result):
+        practice_key = find_practice_id(practice) or practice
+        if practice_key not in triage_found and practice_key in pillar_by_id and practice_key not in uncertain:
+            uncertain.append(practice_key)
+
+    # The practices that matter most come first in case the budget runs out
+    candidates = (
+        [practice_key for practice_key in uncertain if pillar_by_id[practice_key] in escalate_pillars]
+        + [practice_key for practice_key in triage_found if pillar_by_id.get(practice_key) in escalate_pillars]
+        + [practice_key for practice_key in uncertain if pillar_by_id[practice_key] not in escalate_pillars]
+    )
+    elapsed = time.perf_counter() - started
+    escalated = set(candidates[:max_escalated]) if elapsed < budget_seconds else set()
+    log_event('routing', triage_model_id=triage_model_id, model_id=model_id, triage_found=len(triage_found),
+              uncertain=len(uncertain), escalated=len(escalated), over_budget=len(candidates) - len(escalated),
+              seconds_before_escalation=round(elapsed, 3))
+    for tier, count in (('triage', len(triage_found)), ('uncertain', len(uncertain)), ('escalated', len(escalated))):
+        trace_count(f"routing_{tier}", count)
+        registry.inc('wa_routing_practices_total', count, help_text='Best practices by routing decision', tier=tier)
+
+    # Triage findings stand unless escalated; uncertain practices that were not escalated count as not applied
+    kept_lines = [f"[{practice}]: {reason}" for practice_key, (practice, reason) in triage_found.items() if practice_key not in escalated]
+    if triage_on_line is not None:
+        for line in kept_lines:
+            if pillar_by_id.get(find_practice_id(line) or '') in escalate_pillars:
+                on_line(line)
+
+    complete = elapsed < budget_seconds or not candidates
+    escalation_result = ''
+    fallback_lines = []
+    if escalated:
+        escalated_practices = []
+        for entry in best_practices:
+            names = [name for name in entry['Best Practice'] if (find_practice_id(name) or name) in escalated]
+            if names:
+                escalated_practices.append(dict(entry, **{'Best Practice': names}))
+        # The escalation only gets what is left of the budget
+        unfinished = []
+        with stage('analysis_escalation', model_id=model_id):
+            escalation_result = run_model(bedrock_client, template_chunks, escalated_practices, settings, model_id,
+                                          on_line, prompt_options, deadline=started + budget_seconds, unfinished=unfinished)
+        if unfinished:
+            # Practices whose calls ran out of time keep their triage findings
+            late = {find_practice_id(name) or name for shard in unfinished for entry in shard for name in entry['Best Practice']}
+            fallback_lines = [f"[{practice}]: {reason}" for practice_key, (practice, reason) in triage_found.items() if practice_key in late]
+            complete = False
+            log_event('routing_deadline', model_id=model_id, unfinished_calls=len(unfinished), late_practices=len(late),
+                      seconds=round(time.perf_counter() - started, 3))
+            if on_line is not None:
+                for line in fallback_lines:
+                    on_line(line)
+    return merge_analysis_results(["\n".join(kept_lines), escalation_result, "\n".join(fallback_lines)]), complete
+
+
+def with_rule_outcomes(stacks, rule_outcomes):
+    # Runs the rules on each stack while it is being chunked, so no stack is loaded twice
+    for prefix, stack_template in stacks:
+        collect_rule_outcomes(stack_template, rule_outcomes)
+        yield prefix, stack_template
+
+
+@timed('analysis')
+def analyze_template(bedrock_client, catalog, template_body, settings, analysis_cache=None, on_practice=None, source=None,
+                     fetch_template=None, analysis_history=None, history_key=None):
+    # Returns the "[BP name]: reason" analysis; Bedrock errors are raised to the caller.
+    # fetch_template(url) returns the body of a nested stack's template (see make_template_fetcher).
+    # With analysis_history and a history_key (workload and template name), only the best
+    # practices affected by resources changed since the last version go to the model.
+    started = time.perf_counter()
+    model_id = settings.get("model_id", DEFAULT_MODEL_ID)
+    triage_model_id = settings.get("triage_model_id")
+    # Every setting that changes which model sees which practice is part of the cache keys
+    model_route = model_id
+    if triage_model_id:
+        model_route = (f"{triage_model_id}>{model_id}:{sorted(settings.get('escalate_pillars', DEFAULT_ESCALATE_PILLARS))}:"
+                       f"{settings.get('escalation_max_practices', DEFAULT_ESCALATION_MAX_PRACTICES)}")
+    shard_mode = settings.get("analysis_shard_mode", "pillar")
+    shard_token_budget = int(settings.get("analysis_shard_token_budget", 0))
+    template_token_budget = int(settings.get("template_token_budget", DEFAULT_TEMPLATE_TOKEN_BUDGET))
+    template_max_chunks = int(settings.get("template_max_chunks", DEFAULT_MAX_TEMPLATE_CHUNKS))
+    nested_stack_depth = int(settings.get("nested_stack_depth", DEFAULT_NESTED_STACK_DEPTH))
+    output_mode = settings.get("analysis_output_mode", DEFAULT_OUTPUT_MODE)
+    # Bedrock prompt caching of the best practices prefix; only some models support it
+    prompt_options = PromptOptions(output_mode, bool(settings.get("prompt_caching", False)), False)
+    # "assist": rules settle what they can and Bedrock gets the rest; "only": no Bedrock; "off": Bedrock only
+    rule_engine_mode = settings.get("rule_engine_mode", "assist")
+    incremental = analysis_history is not None and history_key is not None and settings.get("incremental_analysis", True)
+    best_practices = catalog.best_practices()
+
+    # Streamed lines are parsed one at a time and handed to on_practice(practice, reason, pillar, question)
+    def stream_line(line):
+        for label, reason in parse_analysis(line):
+            entry = catalog.resolve_practice(label)
+            if entry:
+                on_practice(entry.name, reason, entry.pillar, entry.question)
+    on_line = stream_line if on_practice is not None else None
+
+    # The model cannot fetch the template from S3, so send it the parsed template itself,
+    # split into chunks when the template and its nested stacks exceed the token budget
+    template = None
+    rule_outcomes = None
+    fingerprints = None
+    if template_body is not None:
+        try:
+            template = load_template(template_body)
+        except TemplateParseError as e:
+            print(f"Could not parse template, sending it truncated: {e}")
+            template_chunks = [truncate_template_body(template_body, template_token_budget)]
+    else:
+        template_chunks = [f"(template stored at {source})"]
+    if template is not None:
+        stacks = iter_stacks(template, fetch_template, nested_stack_depth)
+        if rule_engine_mode != 'off':
+            rule_outcomes = {}
+            stacks = with_rule_outcomes(stacks, rule_outcomes)
+        if incremental:
+            fingerprints = {}
+            stacks = with_fingerprints(stacks, fingerprints)
+        template_chunks = chunk_stacks(stacks, template_token_budget, template_max_chunks)
+
+    # Identical inventory (nested stacks included) + catalog + model means an identical review, so reuse it
+    cache_key = None
+    if template_body is not None and analysis_cache is not None:
+        cache_variant = f"{analysis_prompt_version}:{shard_mode}:{shard_token_budget}:{template_token_budget}:{template_max_chunks}:{rule_engine_mode}:{rules_version}:{output_mode}"
+        cache_key = make_cache_key('\n\n'.join(template_chunks), catalog.content, model_route, cache_variant)
+        cached_result = analysis_cache.get(cache_key)
+        if cached_result is not None:
+            if on_line is not None:
+                for line in cached_result.splitlines():
+                    on_line(line)
+            return cached_result
+
+    # Practices the rule engine settles from the template never reach Bedrock
+    partial_results = []
+    if rule_outcomes is not None:
+        rule_results = settle_rule_outcomes(rule_outcomes, best_practices)
+        partial_results.append(format_rule_results(rule_results))
+        if on_line is not None:
+            for line in partial_results[-1].splitlines():
+                on_line(line)
+        best_practices = remaining_best_practices(best_practices, rule_results.settled)
+        print(f"Rule engine settled {len(rule_results.settled)} best practices ({len(rule_results.applied)} applied)")
+    if rule_engine_mode == 'only':
+        best_practices = []
+
+    # Findings of practices no changed resource can affect are carried forward from the last version
+    evaluated = set()
+    carried_findings = ''
+    history_variant = f"{analysis_prompt_version}:{model_route}:{template_token_budget}:{template_max_chunks}:{output_mode}:{content_hash(catalog.content)}"
+    previous = analysis_history.get(content_hash(history_key)) if fingerprints is not None and best_practices else None
+    if previous and previous.get('variant') == history_variant:
+        changes = diff_resources(previous['fingerprints'], fingerprints)
+        questions = affected_questions(changes)
+        if questions is None:
+            print("Incremental analysis: the changes can affect any best practice, analyzing all of them")
+        else:
+            practice_count = sum(len(entry['Best Practice']) for entry in best_practices)
+            best_practices, evaluated = split_best_practices(best_practices, questions, set(previous['evaluated']))
+            carried_findings = carry_forward_findings(previous['findings'], catalog, evaluated)
+            print(f"Incremental analysis: {len(changes.added)} added, {len(changes.modified)} modified, "
+                  f"{len(changes.removed)} removed resources; re-evaluating "
+                  f"{practice_count - len(evaluated)} of {practice_count} best practices")
+            if carried_findings:
+                partial_results.append(carried_findings)
+                if on_line is not None:
+                    for line in carried_findings.splitlines():
+                        on_line(line)
+
+    model_results = ''
+    # Results the escalation budget cut short depend on timing, so they are neither cached nor kept as history
+    complete = True
+    if best_practices and triage_model_id:
+        model_results, complete = run_tiered_analysis(bedrock_client, template_chunks, best_practices, settings, started,
+                                                      on_line, prompt_options)
+    elif best_practices:
+        model_results = run_model(bedrock_client, template_chunks, best_practices, settings, model_id, on_line, prompt_options)
+    if best_practices:
+        partial_results.append(model_results)
+        evaluated.update(practice for entry in best_practices for practice in entry['Best Practice'])
+    analysis_result = merge_analysis_results(partial_results)
+    #for debugging
+    #print(analysis_result)
+    if not complete:
+        print("Escalation ran out of time budget, not caching this analysis")
+    if cache_key and analysis_result and complete:
+        analysis_cache.put(cache_key, analysis_result, metadata={'model_id': model_route, 'source': source})
+    if fingerprints is not None and evaluated and complete:
+        analysis_history.put(content_hash(history_key), {
+            'variant': history_variant,
+            'fingerprints': fingerprints,
+            'evaluated': sorted(evaluated),
+            'findings': merge_analysis_results([carried_findings, model_results])
+        }, metadata={'history_key': history_key, 'source': source})
+    return analysis_result
+
+
+@timed('explain')
+def explain_practices(bedrock_client, catalog, template_body, practice_ids, settings, fetch_template=None):
+    # {practice id: reason} for practices already found, asked for only when the user wants them
+    model_id = settings.get("model_id", DEFAULT_MODEL_ID)
+    template_token_budget = int(settings.get("template_token_budget", DEFAULT_TEMPLATE_TOKEN_BUDGET))
+    try:
+        template = load_template(template_body)
+        template_summary = "\n\n".join(chunk_stacks(
+            iter_stacks(template, fetch_template, int(settings.get("nested_stack_depth", DEFAULT_NESTED_STACK_DEPTH))),
+            template_token_budget,
+            int(settings.get("template_max_chunks", DEFAULT_MAX_TEMPLATE_CHUNKS))
+        ))
+    except TemplateParseError as e:
+        print(f"Could not parse template, sending it truncated: {e}")
+        template_summary = truncate_template_body(template_body, template_token_budget)
+
+    practice_names = [catalog.by_id[practice_id].name for practice_id in practice_ids if practice_id in catalog.by_id]
+    if not practice_names:
+        return {}
+    text = invoke_bedrock_analysis(bedrock_client, build_explain_prompt(template_summary, practice_names), model_id)
+    return {practice.id: reason for practice, reason in catalog.match_analysis(text)}
+
+
+def get_review_snapshot(wa_client, workload_id, lens_alias, settings):
+    # All pillars' answers fetched in one concurrent round and shared until they change
+    return get_snapshot(
+        wa_client,
+        workload_id,
+        lens_alias,
+        ttl_seconds=int(settings.get("wa_snapshot_ttl_seconds", DEFAULT_TTL_SECONDS)),
+        max_workers=int(settings.get("wa_max_workers", 6))
+    )
+
+
+def applied_practices_from_analysis(analysis_results, catalog):
+    return [practice for practice, reason in catalog.match_analysis(analysis_results)]
+
+
+@timed('answer_update')
+def update_answers(wa_client, workload_id, lens_alias, analysis_results, catalog, settings, dry_run=False):
+    # Returns (plan, responses, errors); with dry_run nothing is written and responses/errors are empty
+    snapshot = get_review_snapshot(wa_client, workload_id, lens_alias, settings)
+    applied_practices = applied_practices_from_analysis(analysis_results, catalog)
+
+    # Work out the final choices per question; only questions that change are sent
+    plan = plan_answer_updates(snapshot, applied_practices)
+    print(f"Planned {len(plan)} update_answer calls for {len(applied_practices)} applied best practices")
+    if dry_run:
+        return plan, {}, {}
+
+    responses, errors = apply_answer_updates(
+        wa_client,
+        workload_id,
+        lens_alias,
+        plan,
+        max_workers=int(settings.get("wa_update_max_workers", 4)),
+        max_attempts=int(settings.get("wa_update_max_attempts", 5))
+    )
+    for question_id, response in responses.items():
+        print(f"Updated Question: {question_id} with Choices: {response.get('Answer', {}).get('SelectedChoices')}")
+    for question_id, e in errors.items():
+        print(f"Error updating answer for Question {question_id}: {e}")
+
+    # Answers changed, so the next reader has to fetch a fresh snapshot
+    invalidate_snapshot(workload_id)
+    return plan, responses, errors
+
+
+@timed('milestone')
+def create_workload_milestone(wa_client, workload_id):
+    # Define a milestone name with current date and time
+    current_datetime = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    milestone_name = f'Review completed on {current_datetime}'
+    client_request_token = str(uuid.uuid4())  # Generate a unique client request token
+  
+    try:
+        milestone_response = wa_client.create_milestone(
+            WorkloadId=workload_id,
+            MilestoneName=milestone_name,
+            ClientRequestToken=client_request_token
+        )
+        print("Milestone created")
+        return milestone_response
+
+    except Exception as e:
+        print(f"Error creating milestone: {e}")
+        return None
+
+
+class RiskSummary:
+    # Risk counts of a workload's answers, seeded from one snapshot and kept current from
+    # the Answer each update_answer call returns, so nothing is listed again after an update
+    def __init__(self, snapshot):
+        self.pillars = snapshot.pillars
+        self._question_ids = {
+            pillar_id: [answer['QuestionId'] for answer in snapshot.answers_by_pillar[pillar_id]]
+            for pillar_id, _ in snapshot.pillars
+        }
+        self._risks = {answer['QuestionId']: answer.get('Risk', 'UNANSWERED') for answer in snapshot.answers}
+        self._summary = None
+        self._lock = threading.Lock()
+
+    def apply_answer(self, answer):
+        question_id = answer.get('QuestionId')
+        if question_id not in self._risks or 'Risk' not in answer:
+            return
+        with self._lock:
+            if self._risks[question_id] != answer['Risk']:
+                self._risks[question_id] = answer['Risk']
+                self._summary = None
+
+    def apply_responses(self, responses):
+        # responses: {QuestionId: update_answer response} as returned by update_answers
+        for response in responses.values():
+            self.apply_answer(response.get('Answer', {}))
+
+    def summary(self):
+        # (pillar_summaries, total_questions, answered_questions), counted again only after a risk changed
+        with self._lock:
+            if self._summary is None:
+                self._summary = self._count()
+            return self._summary
+
+    def _count(self):
+        # Initialize counters for different risk levels
+        pillar_summaries = {}
+        total_questions = 0
+        answered_questions = 0
+
+        # Loop through each pillar and its answers
+        for pillar_id, pillar_name in self.pillars:
+            pillar_summaries[pillar_id] = {
+                'name': pillar_name or 'Unknown Pillar',
+                'total': 0,
+                'answered': 0,
+                'high': 0,
+                'medium': 0,
+            }
+
+            for question_id in self._question_ids[pillar_id]:
+                pillar_summaries[pillar_id]['total'] += 1
+                total_questions += 1
+                risk = self._risks[question_id]
+                if risk != 'UNANSWERED':
+                    pillar_summaries[pillar_id]['answered'] += 1
+                    answered_questions += 1
+                if risk == 'HIGH':
+                    pillar_summaries[pillar_id]['high'] += 1
+                elif risk == 'MEDIUM':
+                    pillar_summaries[pillar_id]['medium'] += 1
+
+        return pillar_summaries, total_questions, answered_questions
+
+
+def summarize_snapshot_risks(snapshot):
+    return RiskSummary(snapshot).summary()
+
+
+class MilestoneCache:
+    # Values that are fixed once a milestone exists (report PDF, risk summary) by workload
+    # and lens. A value is kept until a newer milestone of the same workload replaces it.
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, workload_id, lens_alias, milestone_number):
+        with self._lock:
+            cached = self._values.get((workload_id, lens_alias))
+        if cached and milestone_number is not None and cached[0] == milestone_number:
+            return cached[1]
+        return None
+
+    def put(self, workload_id, lens_alias, milestone_number, value):
+        if milestone_number is None:
+            return
+        with self._lock:
+            cached = self._values.get((workload_id, lens_alias))
+            if cached is None or cached[0] <= milestone_number:
+                self._values[(workload_id, lens_alias)] = (milestone_number, value)
+
+
+@timed('report')
+def get_review_report(wa_client, workload_id, lens_alias, milestone_number=None, report_cache=None):
+    # The report PDF as bytes, decoded once. Without a milestone number it is the
+    # report of the current answers, which is not cached.
+    if report_cache is not None:
+        report_pdf = report_cache.get(workload_id, lens_alias, milestone_number)
+        if report_pdf is not None:
+            print(f"Using cached report of milestone {milestone_number}")
+            return report_pdf
+
+    request = {'WorkloadId': workload_id, 'LensAlias': lens_alias}
+    if milestone_number is not None:
+        request['MilestoneNumber'] = milestone_number
+    response = wa_client.get_lens_review_report(**request)
+    base64_string = response.get('LensReviewReport', {}).get('Base64String')
+    if not base64_string:
+        raise ValueError("Failed to retrieve the report data.")
+
+    report_pdf = base64.b64decode(base64_string)
+    if report_cache is not None:
+        report_cache.put(workload_id, lens_alias, milestone_number, report_pdf)
+    return report_pdf
@@ -0,0 +1,149 @@
+import difflib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from catalog import DEFAULT_TITLE_CUTOFF, normalize_title
+from metrics import in_context
+from types import MappingProxyType
+
+# One snapshot of a workload's Well-Architected answers, shared by display,
+# update and risk summary. The lens review is fetched once and every pillar's
+# paginated list_answers runs concurrently; the result is kept for ttl_seconds
+# or until invalidate_snapshot() is called after answers change.
+
+DEFAULT_TTL_SECONDS = 60
+DEFAULT_MAX_WORKERS = 6
+
+
+class AnswersSnapshot:
+    def __init__(self, workload_id, lens_alias, lens_review, answers_by_pillar):
+        self.workload_id = workload_id
+        self.lens_alias = lens_alias
+        self.lens_review = lens_review
+        self.fetched = time.time()
+
+        # (PillarId, PillarName) in the order the lens review lists them
+        self.pillars = tuple(
+            (pillar_summary.get('PillarId'), pillar_summary.get('PillarName'))
+            for pillar_summary in lens_review.get('PillarReviewSummaries', [])
+        )
+        self.answers_by_pillar = MappingProxyType({
+            pillar_id: tuple(answers_by_pillar.get(pillar_id, ())) for pillar_id, _ in self.pillars
+        })
+        answers = [answer for pillar_answers in self.answers_by_pillar.values() for answer in pillar_answers]
+        self.answers = tuple(answers)
+        self.by_question_id = MappingProxyType({answer['QuestionId']: answer for answer in answers})
+        self.by_question_title = MappingProxyType({answer['QuestionTitle'].strip().lower(): answer for answer in answers})
+        self.by_normalized_question_title = MappingProxyType({normalize_title(answer['QuestionTitle']): answer for answer in answers})
+        # QuestionId -> normalized choice title -> ChoiceId
+        self.choice_ids = MappingProxyType({
+            answer['QuestionId']: MappingProxyType({
+                normalize_title(choice['Title']): choice['ChoiceId'] for choice in answer.get('Choices', [])
+            })
+            for answer in answers
+        })
+
+    def pillar_id_for_name(self, pillar_name):
+        for pillar_id, name in self.pillars:
+            if name == pillar_name:
+                return pillar_id
+        return None
+
+    def answer_for_question(self, question_title):
+        answer = self.by_question_title.get(question_title.strip().lower())
+        if answer is None:
+            answer = self.by_normalized_question_title.get(normalize_title(question_title))
+        return answer
+
+    def choice_id_for(self, question_id, title, cutoff=DEFAULT_TITLE_CUTOFF):
+        # Exact normalized title first; small wording drift between the catalog
+        # and the WA Tool is resolved among this question's choices only
+        choices = self.choice_ids.get(question_id, {})
+        normalized = normalize_title(title)
+        choice_id = choices.get(normalized)
+        if choice_id is None and normalized:
+            close_matches = difflib.get_close_matches(normalized, list(choices), n=1, cutoff=cutoff)
+            if close_matches:
+                choice_id = choices[close_matches[0]]
+        return choice_id
+
+
+def list_pillar_answers(wa_client, workload_id, lens_alias, pillar_id):
+    answers = []
+    next_token = None
+    while True:
+        # Build the API request parameters
+        params = {
+            'WorkloadId': workload_id,
+            'LensAlias': lens_alias,
+            'PillarId': pillar_id
+        }
+        if next_token:
+            params['NextToken'] = next_token
+
+        answers_response = wa_client.list_answers(**params)
+        for answer in answers_response.get('AnswerSummaries', []):
+            answer = dict(answer)
+            answer.setdefault('PillarId', pillar_id)
+            answers.append(answer)
+
+        # Check if there are more results
+        next_token = answers_response.get('NextToken')
+        if not next_token:
+            return answers
+
+
+def fetch_snapshot(wa_client, workload_id, lens_alias, max_workers=DEFAULT_MAX_WORKERS):
+    lens_review_response = wa_client.get_lens_review(WorkloadId=workload_id, LensAlias=lens_alias)
+    lens_review = lens_review_response.get('LensReview', {})
+    pillar_ids = [pillar_summary.get('PillarId') for pillar_summary in lens_review.get('PillarReviewSummaries', [])]
+
+    # All pillars at once: the round trip costs about as much as the slowest pillar
+    answers_by_pillar = {}
+    if pillar_ids:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(pillar_ids))) as executor:
+            futures = {
+                pillar_id: executor.submit(in_context(list_pillar_answers), wa_client, workload_id, lens_alias, pillar_id)
+                for pillar_id in pillar_ids
+            }
+            for pillar_id, future in futures.items():
+                answers_by_pillar[pillar_id] = future.result()
+
+    return AnswersSnapshot(workload_id, lens_alias, lens_review, answers_by_pillar)
+
+
+_snapshots = {}
+_snapshot_locks = {}
+_generations = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(wa_client, workload_id, lens_alias, ttl_seconds=DEFAULT_TTL_SECONDS, max_workers=DEFAULT_MAX_WORKERS):
+    key = (workload_id, lens_alias)
+    with _snapshots_lock:
+        snapshot = _snapshots.get(key)
+        if snapshot and time.time() - snapshot.fetched < ttl_seconds:
+            return snapshot
+        key_lock = _snapshot_locks.setdefault(key, threading.Lock())
+
+    # One fetch per workload at a time; sessions arriving meanwhile reuse its result
+    with key_lock:
+        with _snapshots_lock:
+            snapshot = _snapshots.get(key)
+            if snapshot and time.time() - snapshot.fetched < ttl_seconds:
+                return snapshot
+            generation = _generations.get(workload_id, 0)
+        snapshot = fetch_snapshot(wa_client, workload_id, lens_alias, max_workers)
+        with _snapshots_lock:
+            # Don't keep a snapshot that was invalidated while it was being fetched
+            if _generations.get(workload_id, 0) == generation:
+                _snapshots[key] = snapshot
+        return snapshot
+
+
+def invalidate_snapshot(workload_id, lens_alias=None):
+    with _snapshots_lock:
+        _generations[workload_id] = _generations.get(workload_id, 0) + 1
+        for key in list(_snapshots):
+            if key[0] == workload_id and (lens_alias is None or key[1] == lens_alias):
+                del _snapshots[key]
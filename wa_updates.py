@@ -0,0 +1,111 @@
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from metrics import in_context
+
+# Plan the final choice set per question before writing anything, then send
+# only the questions whose SelectedChoices actually change.
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 5
+
+retryable_wa_errors = {'ThrottlingException', 'TooManyRequestsException', 'InternalServerException'}
+
+AnswerUpdate = namedtuple('AnswerUpdate', [
+    'question_id',
+    'question_title',
+    'pillar_id',
+    'current_choices',
+    'new_choices',
+    'added_choices',
+    'practices'
+])
+
+
+def plan_answer_updates(snapshot, applied_practices):
+    # applied_practices are catalog entries; group their choices per question first
+    wanted = {}
+    for practice in applied_practices:
+        answer = snapshot.answer_for_question(practice.question_title)
+        if not answer:
+            continue
+        choice_id = snapshot.choice_id_for(answer['QuestionId'], practice.title)
+        if choice_id:
+            question_choices = wanted.setdefault(answer['QuestionId'], {'choices': set(), 'practices': []})
+            question_choices['choices'].add(choice_id)
+            question_choices['practices'].append(practice.name)
+
+    plan = []
+    for question_id, question_choices in wanted.items():
+        answer = snapshot.by_question_id[question_id]
+        current_choices = list(answer.get('SelectedChoices', []))
+        added_choices = sorted(question_choices['choices'] - set(current_choices))
+        # Nothing new for this question: no call at all
+        if not added_choices:
+            continue
+        plan.append(AnswerUpdate(
+            question_id,
+            answer.get('QuestionTitle'),
+            answer.get('PillarId'),
+            current_choices,
+            current_choices + added_choices,
+            added_choices,
+            question_choices['practices']
+        ))
+    return plan
+
+
+def update_answer_with_retries(wa_client, workload_id, lens_alias, update, notes, max_attempts):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return wa_client.update_answer(
+                WorkloadId=workload_id,
+                LensAlias=lens_alias,
+                QuestionId=update.question_id,
+                SelectedChoices=update.new_choices,
+                Notes=notes
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] not in retryable_wa_errors or attempt == max_attempts:
+                raise
+            # Exponential backoff with full jitter so parallel writers spread out
+            delay = random.uniform(0, min(2 ** attempt, 30))
+            print(f"Throttled updating {update.question_id}, retrying in {delay:.1f}s (attempt {attempt}/{max_attempts})")
+            time.sleep(delay)
+
+
+def apply_answer_updates(wa_client, workload_id, lens_alias, plan, notes='Updated during review process',
+                         max_workers=DEFAULT_MAX_WORKERS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    # Returns ({QuestionId: update_answer response}, {QuestionId: ClientError})
+    responses = {}
+    errors = {}
+    if not plan:
+        return responses, errors
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(plan))) as executor:
+        futures = {
+            update.question_id: executor.submit(in_context(update_answer_with_retries), wa_client, workload_id, lens_alias,
+                                                update, notes, max_attempts)
+            for update in plan
+        }
+        for question_id, future in futures.items():
+            try:
+                responses[question_id] = future.result()
+            except ClientError as e:
+                errors[question_id] = e
+    return responses, errors
+
+
+def describe_plan(plan):
+    # Rows for showing a dry run
+    return [
+        {
+            'Question': update.question_title,
+            'Current choices': len(update.current_choices),
+            'Added choices': len(update.added_choices),
+            'Best practices': ', '.join(update.practices)
+        }
+        for update in plan
+    ]